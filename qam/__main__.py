@@ -11,11 +11,12 @@ import sys
 from datetime import date
 
 import numpy as np
-import pandas as pd
 
-import qam.plotting as pm
-from qam.margin import compute_distances
-from qam.utils.niftireader import load_image
+from qam import cohort, report
+from qam.cohort import lesion_distances, lesion_file_name, margin_data, report_computation
+from qam.margin import compute_distances_label_map
+from qam.utils.niftireader import load_label_map, load_mask, validate_headers
+from qam.utils.writer import OUTPUT_FORMATS, output_format_from_file, write_distances
 
 np.set_printoptions(suppress=True, precision=4)
 today = date.today()
@@ -23,29 +24,84 @@ today = date.today()
 
 def get_args():
     ap = argparse.ArgumentParser()
-    ap.add_argument("-t", "--tumor", required=True, help="path to the tumor segmentation")
-    ap.add_argument("-a", "--ablation", required=True, help="path to the ablation segmentation")
-    ap.add_argument("-om", "--output-margin", required=True, help="output margin (xlsx)")
-    ap.add_argument("-oh", "--output-histogram", required=True, help="output histogram (png)")
+    ap.add_argument("-t", "--tumor", required=False, help="path to the tumor segmentation")
+    ap.add_argument("-a", "--ablation", required=False, help="path to the ablation segmentation")
+    ap.add_argument("-lm", "--label-map", required=False,
+                    help="path to a label map with the tumor (label k) and ablation (label 100+k) of all lesions")
+    ap.add_argument("-alm", "--ablation-label-map", required=False,
+                    help="path to a separate label map of the ablations (label 100+k), used with --label-map")
+    ap.add_argument("-om", "--output-margin", required=True,
+                    help="output margin (xlsx, parquet, feather, npz or csv, given by the extension)")
+    ap.add_argument("-oh", "--output-histogram", required=False, help="output histogram (png)")
     ap.add_argument("-l", "--liver", required=False, help="path to the liver segmentation")
     ap.add_argument("-p", "--patient-id", required=False, help="patient id from study")
     ap.add_argument("-i", "--lesion-id", required=False, help="lesion id")
     ap.add_argument("-d", "--ablation-date", required=False, help="ablation date from study")
+    ap.add_argument("--no-crop", action="store_true", help="compute the distances on the full volume")
+    ap.add_argument("--crop-padding-mm", type=float, default=15.0,
+                    help="padding (mm) around the tumor and ablation when cropping, "
+                         "i.e. the maximum distance of interest (default: 15)")
+    ap.add_argument("--memory-lean", action="store_true",
+                    help="store the distance maps as float32 and avoid temporary sign masks")
+    ap.add_argument("--report-memory", action="store_true", help="print the peak memory of the computation")
+    ap.add_argument("--report-timing", action="store_true",
+                    help="print the load time of every file and the time of the distance computation")
+    ap.add_argument("--cache-dir", required=False,
+                    help="folder caching the decoded masks, later runs on the same files skip the decompression")
+    ap.add_argument("--output-format", choices=OUTPUT_FORMATS, default=None,
+                    help="format of the output margin (default: extension of the output margin)")
+    ap.add_argument("--no-plot", action="store_true",
+                    help="compute the margin without plotting the histogram, --output-histogram is not needed")
+    ap.add_argument("--histogram-dpi", type=int, default=600, help="resolution of the histogram (default: 600)")
     args = vars(ap.parse_args())
+    if args['label_map'] is None and (args['tumor'] is None or args['ablation'] is None):
+        ap.error("either --tumor and --ablation or --label-map are required")
+    if args['output_histogram'] is None and not args['no_plot']:
+        ap.error("--output-histogram is required unless --no-plot is given")
+    if args['output_format'] is None:
+        try:
+            args['output_format'] = output_format_from_file(args['output_margin'])
+        except ValueError as e:
+            ap.error(str(e))
     return args
 
 
+def print_no_surface_distance(patient_id, lesion_id):
+    print('No surface distance computed for patient ' + str(patient_id) + ' lesion ' + str(
+        lesion_id) + '. Lesion could be completely within the subcapsular exclusion zone. '
+                     'Please visualize your segmentation files for more insight.')
+
+
 if __name__ == '__main__':
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        # python -m qam batch cohort_folder -o output_folder
+        cohort.main(sys.argv[2:])
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        # python -m qam report output_folder/distances -o Report.pdf
+        report.main(sys.argv[2:])
+        sys.exit()
+
     args = get_args()
     tumor_file = args['tumor']
     ablation_file = args['ablation']
+    label_map_file = args['label_map']
+    ablation_label_map_file = args['ablation_label_map']
     liver_file = args['liver']
     patient_id = args['patient_id']
     lesion_id = args['lesion_id']
     ablation_date = args['ablation_date']
     output_file_margin = args['output_margin']
     output_file_histogram = args['output_histogram']
+    crop = not args['no_crop']
+    crop_padding_mm = args['crop_padding_mm']
+    memory_lean = args['memory_lean']
+    report_memory = args['report_memory']
+    cache_dir = args['cache_dir']
+    report_timing = args['report_timing']
+    if args['no_plot']:
+        output_file_histogram = None
 
     # check whether the input has been provided for all vars if not give some random values
     if patient_id is None:
@@ -55,72 +111,77 @@ if __name__ == '__main__':
     if ablation_date is None:
         ablation_date = today.strftime("%d-%m-%Y")
 
-    tumor, tumor_np = load_image(tumor_file)
-    # check if there is actually a segmentation in the file
-    has_tumor_segmented = np.sum(tumor_np.astype(np.uint8)) > 0
-    if has_tumor_segmented is False:
-        print('No tumor segmentation mask found in the file provided...program exiting')
-        sys.exit()
-    ablation, ablation_np = load_image(ablation_file)
-    has_ablation_segmented = np.sum(ablation_np.astype(np.uint8)) > 0
-
-    if has_ablation_segmented is False:
-        print('No ablation segmentation mask found in the file provided...program exiting')
-        sys.exit()
-
-    if liver_file is not None:
-        # load the image file
-        liver, liver_np = load_image(liver_file)
-        # check whether there is a liver segmentation or not.
-        has_liver_segmented = np.sum(liver_np.astype(np.uint8)) > 0
-    else:
-        has_liver_segmented = False
-
-    # extract the spacing from the ablation file
-    pixdim = ablation.header['pixdim']
-    spacing = (pixdim[1], pixdim[2], pixdim[3])
-    # compute the surface distances based on tumor and ablation segmentations
-    surface_distance = compute_distances(mask_gt=tumor_np, mask_pred=ablation_np,
-                                         exclusion_zone=liver_np if has_liver_segmented else None,
-                                         spacing_mm=spacing, connectivity=1, crop=False)
-    # call the surface distance extraction function
-    if surface_distance['distances_gt_to_pred'].size > 0:
-        # if surface distances returned are not empty
-        non_ablated, insufficiently_ablated, completely_ablated = \
-            pm.plot_histogram_surface_distances(pat_name=patient_id, lesion_id=lesion_id,
-                                                output_file=output_file_histogram,
-                                                distance_map=surface_distance['distances_gt_to_pred'],
-                                                title='Quantitative Ablation Margin',
-                                                print_case_details=True)
-        df = pd.DataFrame(data={
-            'Patient': [patient_id] * len(surface_distance['distances_gt_to_pred']),
-            'Lesion': [lesion_id] * len(surface_distance['distances_gt_to_pred']),
-            'Distances': surface_distance['distances_gt_to_pred']})
-
-        writer = pd.ExcelWriter(output_file_margin)
-        df.to_excel(writer, sheet_name='surface_distances', index=False, float_format='%.4f')
-        max_distance = np.nanmax(surface_distance['distances_gt_to_pred'])
-        min_distance = np.nanmin(surface_distance['distances_gt_to_pred'])
-        q25_distance = np.nanquantile(surface_distance['distances_gt_to_pred'], 0.25)
-        median_distance = np.nanmedian(surface_distance['distances_gt_to_pred'])
-        q75_distance = np.nanquantile(surface_distance['distances_gt_to_pred'], 0.75)
-
-        patient_data = {'Patient': patient_id,
-                        'Lesion': lesion_id,
-                        'max_distance': max_distance,
-                        'min_distance': min_distance,
-                        'q25_distance': q25_distance,
-                        'median_distance': median_distance,
-                        'q75_distance': q75_distance,
-                        'x_less_than_0mm': non_ablated,
-                        'x_equal_greater_than_0m': insufficiently_ablated,
-                        'x_equal_greater_than_5m': completely_ablated}
-        # save to Excel
-        df_percentages_coverage = pd.DataFrame([patient_data])
-        df_percentages_coverage.to_excel(writer, sheet_name='percentages_coverage', index=False, float_format='%.4f')
-        writer.save()
-
+    # check that all files are on the same voxel grid before loading them
+    try:
+        if label_map_file is not None:
+            validate_headers([label_map_file, ablation_label_map_file, liver_file])
+        else:
+            validate_headers([tumor_file, ablation_file, liver_file])
+    except ValueError as e:
+        print('The segmentation files provided are not aligned...program exiting\n' + str(e))
+        sys.exit(1)
+
+    if label_map_file is not None:
+        # tumor and ablation of all lesions in a single label map
+        ablation, label_map_np = load_label_map(label_map_file)
+        if ablation_label_map_file is not None:
+            ablation, ablation_label_map_np = load_label_map(ablation_label_map_file)
+        else:
+            ablation_label_map_np = None
+        liver_np = None
+        if liver_file is not None:
+            liver, liver_np, liver_stats = load_mask(liver_file, cache_dir=cache_dir)
+            # check whether there is a liver segmentation or not.
+            if liver_stats['empty']:
+                liver_np = None
+
+        # extract the spacing from the ablation file
+        pixdim = ablation.header['pixdim']
+        spacing = (pixdim[1], pixdim[2], pixdim[3])
+        with report_computation(report_timing, report_memory):
+            # compute the surface distances of all lesions in the label map
+            surface_distances = compute_distances_label_map(label_map_np, exclusion_zone=liver_np,
+                                                            spacing_mm=spacing, connectivity=1,
+                                                            crop_padding_mm=crop_padding_mm,
+                                                            ablation_label_map=ablation_label_map_np,
+                                                            memory_lean=memory_lean, crop=crop,
+                                                            outputs={'distances_gt_to_pred'})
+        if len(surface_distances) == 0:
+            print('No tumor (label k) found in the label map provided...program exiting')
+            sys.exit()
+        output_file_histograms = {label: lesion_file_name(output_file_histogram, label)
+                                  if output_file_histogram is not None else None for label in surface_distances}
     else:
-        print('No surface distance computed for patient ' + str(patient_id) + ' lesion ' + str(
-            lesion_id) + '. Lesion could be completely within the subcapsular exclusion zone. '
-                         'Please visualize your segmentation files for more insight.')
+        # compute the surface distances based on tumor and ablation segmentations
+        lesion_surface_distances, error = lesion_distances(tumor_file, ablation_file, liver_file, crop=crop,
+                                                           crop_padding_mm=crop_padding_mm, memory_lean=memory_lean,
+                                                           cache_dir=cache_dir, report_timing=report_timing,
+                                                           report_memory=report_memory)
+        if error is not None:
+            print(error + '...program exiting')
+            sys.exit()
+        surface_distances = {lesion_id: {'distances_gt_to_pred': lesion_surface_distances}}
+        output_file_histograms = {lesion_id: output_file_histogram}
+
+    distances = {}
+    coverage_data = []
+    for label, surface_distance in surface_distances.items():
+        # call the surface distance extraction function
+        if surface_distance is None:
+            # the ablation of the lesion is missing or covered by its tumor in a single label map
+            print('No ablation (label {0}) found for patient {1} lesion {2}. The tumor could cover its ablation '
+                  'completely (margin <= 0 mm).'.format(100 + label, patient_id, label))
+            coverage_data.append(margin_data(patient_id, label, np.empty(0)))
+        elif surface_distance['distances_gt_to_pred'].size > 0:
+            # if surface distances returned are not empty
+            patient_data = margin_data(patient_id, label, surface_distance['distances_gt_to_pred'],
+                                       output_file_histograms[label], args['histogram_dpi'])
+            distances[label] = surface_distance['distances_gt_to_pred']
+            coverage_data.append(patient_data)
+        else:
+            print_no_surface_distance(patient_id, label)
+            coverage_data.append(margin_data(patient_id, label, np.empty(0)))
+
+    if len(distances) > 0:
+        # save the distances and the coverage data
+        write_distances(output_file_margin, patient_id, distances, coverage_data, output_format=args['output_format'])
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Computation of the ablation margins of a whole cohort in a process pool.
+
+The cohort folder has to be structured as follows (same as in the test data used in the repository):
+
+    +-- PatientID
+    |   +-- LesionNr
+        |   +-- [PatientID]_L[LesionNr]_Ablation.nii.gz
+        |   +-- [PatientID]_L[LesionNr]_Liver.nii.gz (optional)
+        |   +-- [PatientID]_L[LesionNr]_Tumor.nii.gz
+"""
+
+import argparse
+import contextlib
+import os
+import time
+import traceback
+import tracemalloc
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import qam.plotting as pm
+from qam.margin import compute_distances, summarize_distances
+from qam.utils.niftireader import canonical_order, load_masks, validate_headers
+from qam.utils.writer import OUTPUT_FORMATS, write_distances
+
+
+def lesion_file_name(output_file, lesion_id):
+    """
+    Adds the lesion id to an output file name, e.g. Histogram.png -> Histogram_L2.png
+    """
+    root, ext = os.path.splitext(output_file)
+    return '{0}_L{1}{2}'.format(root, lesion_id, ext)
+
+
+def margin_data(patient_id, lesion_id, distances, output_file_histogram=None, histogram_dpi=600):
+    """
+    Summarizes the surface distances and plots their histogram.
+    :param output_file_histogram: output file of the histogram, None (default) to skip the plot
+    :param histogram_dpi: resolution of the histogram, 600 by default
+    :return: dictionary with the coverage data
+    """
+    if output_file_histogram is not None:
+        pm.render_histogram_surface_distances(pat_name=patient_id, lesion_id=lesion_id,
+                                              output_file=output_file_histogram,
+                                              distance_map=distances,
+                                              title='Quantitative Ablation Margin',
+                                              print_case_details=True, dpi=histogram_dpi)
+    summary = summarize_distances(distances, percentiles=(25, 50, 75), thresholds=(0, 5))
+    # percentages of the non-ablated (x < 0 mm), insufficiently ablated (0 <= x < 5 mm) and completely ablated surface
+    non_ablated, insufficiently_ablated, completely_ablated = \
+        np.diff([0, summary['below_0mm'], summary['below_5mm'], 1]) * 100
+
+    patient_data = {'Patient': patient_id,
+                    'Lesion': lesion_id,
+                    'max_distance': summary['max'],
+                    'min_distance': summary['min'],
+                    'q25_distance': summary['p25'],
+                    'median_distance': summary['p50'],
+                    'q75_distance': summary['p75'],
+                    'x_less_than_0mm': non_ablated,
+                    'x_equal_greater_than_0m': insufficiently_ablated,
+                    'x_equal_greater_than_5m': completely_ablated}
+    return patient_data
+
+
+@contextlib.contextmanager
+def report_computation(report_timing=False, report_memory=False):
+    """
+    Prints the time and the peak memory of the distance computation run in the with block. Only the allocations in
+    the block are traced, not the loaded masks.
+    """
+    if report_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    yield
+    if report_timing:
+        print('Computed the surface distances in {0:.3f} s'.format(time.perf_counter() - start))
+    if report_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('Peak memory of the distance computation: {0:.1f} MB'.format(peak_memory / 1024 ** 2))
+
+
+def lesion_distances(tumor_file, ablation_file, liver_file=None, crop=True, crop_padding_mm=15.0, memory_lean=False,
+                     cache_dir=None, report_timing=False, report_memory=False):
+    """
+    Loads the segmentations of a lesion and computes the surface distances of the tumor to the ablation. The tumor
+    surface close to the liver capsule is excluded (see compute_distances).
+    :param tumor_file: tumor segmentation
+    :param ablation_file: ablation segmentation
+    :param liver_file: None (default) or the liver segmentation
+    :param crop: True (default)/False. Compute the distances on the padded bounding box or on the full volume.
+    :param crop_padding_mm: padding (mm) around the tumor and ablation when cropping
+    :param memory_lean: True/False (default). Store the distance maps as float32 (see compute_distances).
+    :param cache_dir: None (default) or a folder caching the decoded masks (see load_mask)
+    :param report_timing: True/False (default). Print the load time of every file and the time of the computation.
+    :param report_memory: True/False (default). Print the peak memory of the computation.
+    :return: (surface distances, None) or (None, error message) if the tumor or the ablation segmentation is empty.
+    The distances are in the same order as on canonical masks (see canonical_order), whatever the voxel order of the
+    files.
+    """
+    # in the voxel order of the files if they are aligned, see load_masks
+    files = [tumor_file, ablation_file, liver_file]
+    masks = load_masks(files, cache_dir=cache_dir)
+    (tumor, tumor_np, tumor_stats), (ablation, ablation_np, ablation_stats), liver_mask = masks
+    if report_timing:
+        for file, mask in zip(files, masks):
+            if mask is not None:
+                print('Loaded {0} in {1:.3f} s'.format(file, mask[2]['load_time']))
+    # check if there is actually a segmentation in the file
+    if tumor_stats['empty']:
+        return None, 'No tumor segmentation mask found in the file provided'
+    if ablation_stats['empty']:
+        return None, 'No ablation segmentation mask found in the file provided'
+    liver_np = None
+    if liver_mask is not None:
+        liver, liver_np, liver_stats = liver_mask
+        if liver_stats['empty']:
+            liver_np = None
+
+    pixdim = ablation.header['pixdim']
+    spacing = (pixdim[1], pixdim[2], pixdim[3])
+    with report_computation(report_timing, report_memory):
+        surface_distance = compute_distances(mask_gt=tumor_np, mask_pred=ablation_np, exclusion_zone=liver_np,
+                                             spacing_mm=spacing, connectivity=1, crop=crop,
+                                             crop_padding_mm=crop_padding_mm, memory_lean=memory_lean,
+                                             local_exclusion=True,
+                                             outputs={'distances_gt_to_pred', 'border_indices_gt'})
+        # same order of the distances as on canonical masks
+        distances = surface_distance['distances_gt_to_pred'][
+            canonical_order(surface_distance['border_indices_gt'], ablation.affine, ablation.shape)]
+    return distances, None
+
+
+def _lesion_files(root, patient_id, lesion_id):
+    lesion_folder = os.path.join(root, patient_id, lesion_id)
+    files = {}
+    for segmentation in ['Tumor', 'Ablation', 'Liver']:
+        files[segmentation.lower()] = os.path.join(lesion_folder, '{0}_L{1}_{2}.nii.gz'.format(
+            patient_id, lesion_id, segmentation))
+    if not os.path.exists(files['liver']):
+        files['liver'] = None
+    return files
+
+
+def _sub_folders(folder):
+    return sorted(x for x in os.listdir(folder) if os.path.isdir(os.path.join(folder, x))
+                  and not x.startswith('_') and not x.startswith('.'))
+
+
+def discover_lesions(root):
+    """
+    Finds all lesions of a cohort folder (PatientID/LesionNr/[PatientID]_L[LesionNr]_{Tumor,Ablation,Liver}.nii.gz).
+    :param root: cohort folder
+    :return: list of dictionaries with the patient id, lesion id and the paths of the segmentations (liver may be None)
+    """
+    lesions = []
+    for patient_id in _sub_folders(root):
+        for lesion_id in _sub_folders(os.path.join(root, patient_id)):
+            lesion = {'patient_id': patient_id, 'lesion_id': lesion_id}
+            lesion.update(_lesion_files(root, patient_id, lesion_id))
+            lesions.append(lesion)
+    return lesions
+
+
+def process_lesion(lesion, output_dir, crop_padding_mm=15.0, memory_lean=False, cache_dir=None,
+                   output_format='xlsx', plot=True, histogram_dpi=600):
+    """
+    Computes, plots and saves the margin of a single lesion. Runs in a worker process.
+    :param lesion: dictionary as returned by discover_lesions
+    :param output_dir: folder for the distances (distances/) and the histograms (histograms/)
+    :param crop_padding_mm: padding (mm) around the tumor and ablation when cropping
+    :param memory_lean: True/False (default). Store the distance maps as float32 (see compute_distances).
+    :param cache_dir: None (default) or a folder caching the decoded masks (see load_mask)
+    :param output_format: format of the distances (see write_distances), xlsx by default
+    :param plot: True (default)/False. Plot the histogram of the surface distances.
+    :param histogram_dpi: resolution of the histogram, 600 by default
+    :return: (lesion, coverage data or None, error message or None)
+    """
+    patient_id = lesion['patient_id']
+    lesion_id = lesion['lesion_id']
+    try:
+        distances, error = lesion_distances(lesion['tumor'], lesion['ablation'], lesion['liver'],
+                                            crop_padding_mm=crop_padding_mm, memory_lean=memory_lean,
+                                            cache_dir=cache_dir)
+        if error is not None:
+            return lesion, None, error
+        if distances.size == 0:
+            return lesion, None, 'No surface distance computed. Lesion could be completely within the ' \
+                                 'subcapsular exclusion zone'
+
+        name = '{0}_L{1}'.format(patient_id, lesion_id)
+        output_file_histogram = os.path.join(output_dir, 'histograms', name + '_Histogram.png') if plot else None
+        patient_data = margin_data(patient_id, lesion_id, distances, output_file_histogram, histogram_dpi)
+        write_distances(os.path.join(output_dir, 'distances', '{0}_Distances.{1}'.format(name, output_format)),
+                        patient_id, {lesion_id: distances}, [patient_data])
+        return lesion, patient_data, None
+    except Exception:
+        return lesion, None, traceback.format_exc()
+
+
+def run_cohort(root, output_dir, jobs=None, crop_padding_mm=15.0, memory_lean=False, cache_dir=None,
+               output_format='xlsx', plot=True, histogram_dpi=600):
+    """
+    Computes the margins of all lesions of a cohort folder in a process pool.
+    Lesions whose files are not on the same voxel grid are rejected up front (see validate_headers).
+    A failing lesion is reported and does not stop the computation of the others, even if it kills its worker process.
+    :param root: cohort folder (see discover_lesions)
+    :param output_dir: output folder. The aggregated margins of all lesions are saved to Aggregated.xlsx.
+    :param jobs: number of worker processes. None (default) uses the number of CPUs.
+    :param crop_padding_mm: padding (mm) around the tumor and ablation when cropping
+    :param memory_lean: True/False (default). Store the distance maps as float32, e.g. to run more workers per node.
+    :param cache_dir: None (default) or a folder caching the decoded masks, e.g. for parameter sweeps (see load_mask)
+    :param output_format: format of the distances of every lesion (see write_distances), xlsx by default
+    :param plot: True (default)/False. Plot the histogram of every lesion, skipping the plots saves most of the time
+    of small lesions.
+    :param histogram_dpi: resolution of the histograms, 600 by default
+    :return: DataFrame with the coverage data of all lesions and a DataFrame with the failed lesions
+    """
+    lesions = discover_lesions(root)
+    for folder in ['distances', 'histograms'] if plot else ['distances']:
+        os.makedirs(os.path.join(output_dir, folder), exist_ok=True)
+
+    coverage_data = []
+    failures = []
+    # reject misaligned lesions from their headers before starting any computation
+    valid_lesions = []
+    for lesion in lesions:
+        try:
+            validate_headers([lesion['tumor'], lesion['ablation'], lesion['liver']])
+            valid_lesions.append(lesion)
+        except Exception as e:
+            failures.append({'Patient': lesion['patient_id'], 'Lesion': lesion['lesion_id'], 'Error': str(e)})
+            print('Patient {0} lesion {1} rejected: {2}'.format(lesion['patient_id'], lesion['lesion_id'], e))
+    lesions = valid_lesions
+
+    task = partial(process_lesion, output_dir=output_dir, crop_padding_mm=crop_padding_mm, memory_lean=memory_lean,
+                   cache_dir=cache_dir, output_format=output_format, plot=plot, histogram_dpi=histogram_dpi)
+    results = []
+
+    def collect(lesion, patient_data, error):
+        status = 'done'
+        if error is None:
+            coverage_data.append(patient_data)
+        else:
+            status = 'failed'
+            failures.append({'Patient': lesion['patient_id'], 'Lesion': lesion['lesion_id'], 'Error': error})
+        results.append(lesion)
+        print('[{0}/{1}] Patient {2} lesion {3} {4}'.format(len(results), len(lesions), lesion['patient_id'],
+                                                            lesion['lesion_id'], status))
+
+    # at most one lesion per worker is submitted, so a dying worker only interrupts the lesions being computed
+    workers = jobs if jobs is not None else os.cpu_count()
+    pending = deque(lesions)
+    interrupted = []
+    while len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            running = {}
+            broken = False
+            while len(running) > 0 or (len(pending) > 0 and not broken):
+                while len(pending) > 0 and not broken and len(running) < workers:
+                    lesion = pending.popleft()
+                    try:
+                        running[executor.submit(task, lesion)] = lesion
+                    except BrokenProcessPool:
+                        pending.appendleft(lesion)
+                        broken = True
+                if len(running) == 0:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    lesion = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        # a worker process died (e.g. killed when out of memory), the remaining lesions are
+                        # computed in a new pool
+                        interrupted.append(lesion)
+                        broken = True
+                        continue
+                    except Exception:
+                        result = lesion, None, traceback.format_exc()
+                    collect(*result)
+    # the lesions running when a pool broke are retried one at a time, only a lesion killing its own worker fails
+    for lesion in interrupted:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                result = executor.submit(task, lesion).result()
+            except Exception:
+                result = lesion, None, traceback.format_exc()
+        collect(*result)
+
+    df_coverage = pd.DataFrame(coverage_data)
+    if len(df_coverage) > 0:
+        df_coverage = df_coverage.sort_values(['Patient', 'Lesion'])
+    df_failures = pd.DataFrame(failures, columns=['Patient', 'Lesion', 'Error'])
+
+    writer = pd.ExcelWriter(os.path.join(output_dir, 'Aggregated.xlsx'))
+    df_coverage.to_excel(writer, sheet_name='percentages_coverage', index=False, float_format='%.4f')
+    df_failures.to_excel(writer, sheet_name='failures', index=False)
+    writer.save()
+    return df_coverage, df_failures
+
+
+def get_args(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m qam batch')
+    ap.add_argument("root", help="cohort folder (PatientID/LesionNr/[PatientID]_L[LesionNr]_Tumor.nii.gz ...)")
+    ap.add_argument("-o", "--output-dir", required=True, help="output folder")
+    ap.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: nr of CPUs)")
+    ap.add_argument("--crop-padding-mm", type=float, default=15.0,
+                    help="padding (mm) around the tumor and ablation when cropping (default: 15)")
+    ap.add_argument("--memory-lean", action="store_true",
+                    help="store the distance maps as float32 and avoid temporary sign masks")
+    ap.add_argument("--cache-dir", required=False,
+                    help="folder caching the decoded masks, later runs on the same files skip the decompression")
+    ap.add_argument("--output-format", choices=OUTPUT_FORMATS, default='xlsx',
+                    help="format of the distances of every lesion (default: xlsx)")
+    ap.add_argument("--no-plot", action="store_true", help="compute the margins without plotting the histograms")
+    ap.add_argument("--histogram-dpi", type=int, default=600, help="resolution of the histograms (default: 600)")
+    return vars(ap.parse_args(argv))
+
+
+def main(argv=None):
+    args = get_args(argv)
+    df_coverage, df_failures = run_cohort(args['root'], args['output_dir'], jobs=args['jobs'],
+                                          crop_padding_mm=args['crop_padding_mm'], memory_lean=args['memory_lean'],
+                                          cache_dir=args['cache_dir'], output_format=args['output_format'],
+                                          plot=not args['no_plot'], histogram_dpi=args['histogram_dpi'])
+    print('{0} lesions computed, {1} failed'.format(len(df_coverage), len(df_failures)))
+    for _, failure in df_failures.iterrows():
+        print('Patient {0} lesion {1} failed:\n{2}'.format(failure['Patient'], failure['Lesion'], failure['Error']))
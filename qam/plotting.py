@@ -4,14 +4,23 @@ Created on Wed Nov 15 16:15:51 2017
 
 @author: Raluca Sandu
 """
+import threading
 from collections import OrderedDict
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
+from matplotlib.ticker import PercentFormatter
+
+from qam.margin import coverage_percentages
 
 np.seterr(divide='ignore', invalid='ignore')
 cmap = [(213/255.0, 94/255.0, 0/255.0), (236/255.0, 225/255.0, 51/255.0), (2/255.0, 158/255.0, 115/255.0)]
+# figure templates of render_histogram_surface_distances, one per thread and figure size
+_templates = threading.local()
 
 def plot_histogram_surface_distances(pat_name, lesion_id, output_file, distance_map, title, print_case_details=True, output_vector_format=False):
     """
@@ -108,3 +117,90 @@ def plot_histogram_surface_distances(pat_name, lesion_id, output_file, distance_
     plt.close()
 
     return sum_perc_nonablated, sum_perc_insuffablated, sum_perc_ablated
+
+
+def _histogram_template(figsize, fontsize):
+    """
+    Figure with the static parts of the histogram (axes labels, ticks, limits), created once per thread and size.
+    """
+    templates = getattr(_templates, 'figures', None)
+    if templates is None:
+        templates = _templates.figures = {}
+    key = (tuple(figsize), fontsize)
+    if key not in templates:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.set_xlabel('Surface-to-Surface Exact Euclidean Distances (mm)', fontsize=fontsize, color='black')
+        ax.set_ylabel('Tumor Surface Covered (%)', fontsize=fontsize, color='black')
+        ax.tick_params(axis='both', colors='black', labelsize=fontsize)
+        ax.yaxis.set_major_formatter(PercentFormatter(decimals=0))
+        ax.set_xlim([-15, 15])
+        ax.grid(False)
+        ax.set_rasterized(True)
+        templates[key] = fig, ax
+    return templates[key]
+
+
+def render_histogram_surface_distances(pat_name, lesion_id, output_file, distance_map, title,
+                                       print_case_details=True, output_vector_format=False, dpi=600,
+                                       figsize=(12, 10), fontsize=20):
+    """
+    Plots and saves the surface distances (traffic-light color schemes) between tumor and ablation, like
+    plot_histogram_surface_distances, without the global state of pyplot. The figure is created once per thread and
+    reused for the following lesions, so the function can be called concurrently from a thread pool.
+    :param pat_name: Patient Name
+    :param lesion_id: Lesion 1, 2, 3...etc
+    :param output_file: Name of the img saved to the disk
+    :param distance_map: Array containing all the surface distances computed.
+    :param title: Title of the plot.
+    :param print_case_details: True/False to plot an extended title on the image.
+    :param output_vector_format: True/False (default) to save the figure also as svg and eps.
+    :param dpi: resolution of the saved image, 600 by default
+    :param figsize: size of the figure in inches, (12, 10) by default
+    :param fontsize: size of the text, 20 by default (fits the default figure size)
+    :return: The percentages of non-ablated, insufficiently ablated and completely ablated tumor surface.
+    """
+    fig, ax = _histogram_template(figsize, fontsize)
+    # remove the bars and the legend of the previous lesion
+    for container in list(ax.containers):
+        container.remove()
+    if ax.get_legend() is not None:
+        ax.get_legend().remove()
+
+    distance_map = np.asarray(distance_map)
+    if len(distance_map) == 0:
+        min_val = -15
+        max_val = 15
+    else:
+        min_val = int(np.floor(np.min(distance_map)))
+        max_val = int(np.ceil(np.max(distance_map)))
+    bins = np.arange(min_val, max_val + 1.5, 1)
+    col_height, _ = np.histogram(distance_map, bins=bins)
+    percentages = coverage_percentages(distance_map)
+
+    # color of every bin from the class of its left edge, bars in percent of the tumor surface
+    bin_classes = np.digitize(bins[:-1], (0, 5))
+    ax.bar(bins[:-1], col_height / max(len(distance_map), 1) * 100, width=1, align='edge',
+           color=np.asarray(cmap)[bin_classes], edgecolor='black')
+    ax.relim()
+    ax.autoscale_view()
+
+    labels = ['Ablation Margin ' + r'$x < 0$' + 'mm :' + " %.2f" % percentages[0] + '%',
+              'Ablation Margin ' + r'$0 \leq x < 5$' + 'mm: ' + "%.2f" % percentages[1] + '%',
+              'Ablation Margin ' + r'$x \geq 5$' + 'mm: ' + " %.2f" % percentages[2] + '%']
+    classes = [c for c in range(3) if np.any(col_height[bin_classes == c] > 0)]
+    ax.legend([Patch(facecolor=cmap[c], edgecolor='black') for c in classes], [labels[c] for c in classes],
+              fontsize=fontsize, loc='upper left')
+    if print_case_details:
+        ax.set_title(title + '. Case ' + str(pat_name) + '. Lesion ' + str(lesion_id), fontsize=fontsize)
+    else:
+        ax.set_title(title, fontsize=fontsize)
+
+    if output_file is not None:
+        fig.savefig(output_file, dpi=dpi, bbox_inches='tight')
+        if output_vector_format:
+            fig.savefig(output_file + '.svg', dpi=dpi)
+            fig.savefig(output_file + '.eps', dpi=dpi)
+
+    return tuple(percentages)
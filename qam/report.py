@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Report of a cohort with the histograms of the surface distances of many lesions, as a multi-page PDF or as image grids.
+
+The histogram of every lesion (panel) is rendered in a process pool and cached by the hash of its distances and of the
+rendering parameters, so regenerating the report of a cohort after adding some lesions only renders the new panels:
+
+    python -m qam report cohort_output/distances -o Report.pdf
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from PIL import Image
+
+from qam.plotting import render_histogram_surface_distances
+from qam.utils.writer import OUTPUT_FORMATS, read_distances
+
+REPORT_FORMATS = ['pdf', 'png']
+
+
+def panel_key(patient_id, lesion_id, distances, dpi, figsize):
+    """
+    Content hash of a panel: the patient, the lesion, the surface distances and the rendering parameters.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps({'Patient': str(patient_id), 'Lesion': str(lesion_id), 'dpi': dpi,
+                         'figsize': [float(x) for x in figsize]}, sort_keys=True).encode())
+    h.update(np.ascontiguousarray(distances, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def render_panel(patient_id, lesion_id, distances, panel_file, dpi=150, figsize=(6, 5)):
+    """
+    Renders the histogram of a lesion to a panel file. Runs in a worker process.
+    The panel is written to a temporary file first, an interrupted run never leaves a truncated panel in the cache.
+    """
+    tmp_file = '{0}.{1}.tmp.png'.format(os.path.splitext(panel_file)[0], os.getpid())
+    render_histogram_surface_distances(pat_name=patient_id, lesion_id=lesion_id, output_file=tmp_file,
+                                       distance_map=distances, title='Quantitative Ablation Margin',
+                                       print_case_details=True, dpi=dpi, figsize=figsize,
+                                       fontsize=20 * figsize[1] / 10)
+    os.replace(tmp_file, panel_file)
+    return panel_file
+
+
+def render_panels(lesions, panel_dir, jobs=None, dpi=150, figsize=(6, 5)):
+    """
+    Renders the panels of many lesions in a process pool, panels found in panel_dir are not rendered again.
+    :param lesions: list of (patient id, lesion id, surface distances)
+    :param panel_dir: folder caching the panels, named by their content hash (see panel_key)
+    :param jobs: number of worker processes. None (default) uses the number of CPUs, 1 renders in this process.
+    :param dpi: resolution of the panels
+    :param figsize: size of the panels in inches
+    :return: list with the panel file of every lesion and the number of rendered panels
+    """
+    os.makedirs(panel_dir, exist_ok=True)
+    panel_files = [os.path.join(panel_dir, panel_key(patient_id, lesion_id, distances, dpi, figsize) + '.png')
+                   for patient_id, lesion_id, distances in lesions]
+    missing = {}
+    for lesion, panel_file in zip(lesions, panel_files):
+        if not os.path.exists(panel_file):
+            missing[panel_file] = lesion
+    if jobs == 1:
+        for panel_file, (patient_id, lesion_id, distances) in missing.items():
+            render_panel(patient_id, lesion_id, distances, panel_file, dpi, figsize)
+    elif len(missing) > 0:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(render_panel, patient_id, lesion_id, distances, panel_file, dpi, figsize)
+                       for panel_file, (patient_id, lesion_id, distances) in missing.items()]
+            for future in futures:
+                future.result()
+    return panel_files, len(missing)
+
+
+def _pages(panel_files, columns, rows):
+    """
+    Tiles the panels to pages of columns x rows panels (RGB arrays), every panel centered in a cell of the size of
+    the largest panel.
+    """
+    sizes = []
+    for panel_file in panel_files:
+        with Image.open(panel_file) as panel:
+            sizes.append(panel.size)
+    cell_width, cell_height = np.max(sizes, axis=0)
+    panels_per_page = columns * rows
+    for start in range(0, len(panel_files), panels_per_page):
+        page = np.full((rows * cell_height, columns * cell_width, 3), 255, dtype=np.uint8)
+        for i, panel_file in enumerate(panel_files[start:start + panels_per_page]):
+            with Image.open(panel_file) as panel:
+                panel = np.asarray(panel.convert('RGB'))
+            top = (i // columns) * cell_height + (cell_height - panel.shape[0]) // 2
+            left = (i % columns) * cell_width + (cell_width - panel.shape[1]) // 2
+            page[top:top + panel.shape[0], left:left + panel.shape[1]] = panel
+        yield page
+
+
+def cohort_report(lesions, output_file, panel_dir=None, jobs=None, columns=3, rows=4, dpi=150, figsize=(6, 5)):
+    """
+    Report with the histograms of the surface distances of many lesions, columns x rows lesions per page.
+    pdf: one multi-page PDF file.
+    png: one image grid per page, [name]_p[PageNr].png if there is more than one page.
+    :param lesions: list of (patient id, lesion id, surface distances)
+    :param output_file: report file, the format is given by the extension (see REPORT_FORMATS)
+    :param panel_dir: folder caching the panels of the lesions. None (default) uses [name]_panels next to the report.
+    :param jobs: number of worker processes rendering the panels. None (default) uses the number of CPUs.
+    :param columns: number of panels per row
+    :param rows: number of rows per page
+    :param dpi: resolution of the panels (and of the report)
+    :param figsize: size of a panel in inches
+    :return: list of the report files and the number of rendered panels
+    """
+    root, ext = os.path.splitext(output_file)
+    report_format = ext.lstrip('.').lower()
+    if report_format not in REPORT_FORMATS:
+        raise ValueError("Unknown report format '{0}' of {1}. Available formats: {2}".format(
+            report_format, output_file, REPORT_FORMATS))
+    if len(lesions) == 0:
+        raise ValueError("No lesions for the report")
+    if panel_dir is None:
+        panel_dir = root + '_panels'
+    panel_files, nr_rendered = render_panels(lesions, panel_dir, jobs=jobs, dpi=dpi, figsize=figsize)
+
+    pages = _pages(panel_files, columns, rows)
+    if report_format == 'pdf':
+        with PdfPages(output_file) as pdf:
+            for page in pages:
+                fig = Figure(figsize=(page.shape[1] / dpi, page.shape[0] / dpi), dpi=dpi)
+                fig.figimage(page)
+                pdf.savefig(fig, dpi=dpi)
+        return [output_file], nr_rendered
+    nr_pages = int(np.ceil(len(panel_files) / (columns * rows)))
+    output_files = [output_file] if nr_pages == 1 else \
+        ['{0}_p{1}{2}'.format(root, page_nr, ext) for page_nr in range(1, nr_pages + 1)]
+    for page_file, page in zip(output_files, pages):
+        Image.fromarray(page).save(page_file)
+    return output_files, nr_rendered
+
+
+def distance_files(paths):
+    """
+    Files with surface distances (see write_distances) given directly or found in folders, sorted by name.
+    The coverage files written next to csv files are skipped.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, x) for x in os.listdir(path)
+                                if os.path.splitext(x)[1].lstrip('.').lower() in OUTPUT_FORMATS
+                                and not x.endswith('_coverage.csv') and not x.startswith('.')))
+        else:
+            files.append(path)
+    return files
+
+
+def get_args(argv=None):
+    ap = argparse.ArgumentParser(prog='python -m qam report')
+    ap.add_argument("distances", nargs='+',
+                    help="files with the surface distances (xlsx, parquet, feather, npz or csv) or folders with them, "
+                         "e.g. the distances folder of python -m qam batch")
+    ap.add_argument("-o", "--output", required=True, help="report (pdf, or png for image grids)")
+    ap.add_argument("--panel-dir", required=False,
+                    help="folder caching the histograms of the lesions (default: [report name]_panels)")
+    ap.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: nr of CPUs)")
+    ap.add_argument("--columns", type=int, default=3, help="number of histograms per row (default: 3)")
+    ap.add_argument("--rows", type=int, default=4, help="number of rows per page (default: 4)")
+    ap.add_argument("--dpi", type=int, default=150, help="resolution of the histograms (default: 150)")
+    return vars(ap.parse_args(argv))
+
+
+def main(argv=None):
+    args = get_args(argv)
+    lesions = []
+    for file in distance_files(args['distances']):
+        patient_id, distances = read_distances(file)
+        lesions.extend((patient_id, lesion_id, lesion_distances) for lesion_id, lesion_distances in distances.items())
+    output_files, nr_rendered = cohort_report(lesions, args['output'], panel_dir=args['panel_dir'],
+                                              jobs=args['jobs'], columns=args['columns'], rows=args['rows'],
+                                              dpi=args['dpi'])
+    print('Report of {0} lesions saved to {1} ({2} histograms rendered, {3} cached)'.format(
+        len(lesions), ', '.join(output_files), nr_rendered, len(lesions) - nr_rendered))
@@ -6,14 +6,88 @@ Created on Mon July 20 2020
 """
 
 
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import nibabel as nib
+from nibabel.orientations import apply_orientation, inv_ornt_aff, io_orientation
+
+try:
+    # optional faster gzip decompression (pip install isal)
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+
+def _load_nifti(file):
+    """
+    Loads a Nifti image. .nii.gz files are decompressed in one go with ISA-L if it is installed, which is several
+    times faster than the zlib stream of nibabel.
+    Otherwise the file is kept open, so reading the data chunk by chunk (see extract_mask) continues the decompression
+    instead of reopening and decompressing the file from the start for every chunk.
+    """
+    if igzip is None or not str(file).endswith('.gz'):
+        return nib.load(file, keep_file_open=True)
+    with open(file, 'rb') as f:
+        image_bytes = igzip.decompress(f.read())
+    # sizeof_hdr is 348 for Nifti1 and 540 for Nifti2, in either byte order
+    if 348 in (int.from_bytes(image_bytes[:4], 'little'), int.from_bytes(image_bytes[:4], 'big')):
+        return nib.Nifti1Image.from_bytes(image_bytes)
+    return nib.Nifti2Image.from_bytes(image_bytes)
+
+
+def extract_mask(image_np, chunk_voxels=2 ** 22):
+    """
+    Binarizes a segmentation (voxels equal to the maximum label) in a single pass, together with its statistics.
+    The array is processed in chunks of about chunk_voxels voxels along its outermost axis in memory (the last axis
+    for the data of a Nifti file, which is then read chunk by chunk). The voxels of the previous chunks are reset when
+    a higher label is found, which is rare for segmentations.
+    A constant volume is a full mask if it is non-zero and an empty mask otherwise.
+    :param image_np: segmentation array or the dataobj of a Nifti image
+    :param chunk_voxels: number of voxels processed at once
+    :return: binary mask and dictionary with "empty", "nr_voxels", "min" and "max" (labels) of the segmentation
+    """
+    if nib.is_proxy(image_np):
+        axis = len(image_np.shape) - 1
+    else:
+        image_np = np.asanyarray(image_np)
+        axis = int(np.argmax(np.abs(image_np.strides))) if image_np.ndim > 0 else 0
+    mask = np.zeros(image_np.shape, dtype=bool)
+    if mask.size == 0:
+        return mask, {"empty": True, "nr_voxels": 0, "min": None, "max": None}
+    step = max(1, chunk_voxels * mask.shape[axis] // mask.size)
+
+    min_value = max_value = None
+    nr_voxels = 0
+    for start in range(0, image_np.shape[axis], step):
+        chunk = (slice(None),) * axis + (slice(start, start + step),)
+        image_chunk = np.asanyarray(image_np[chunk])
+        chunk_min, chunk_max = image_chunk.min(), image_chunk.max()
+        if min_value is None or chunk_min < min_value:
+            min_value = chunk_min
+        if max_value is None or chunk_max > max_value:
+            if max_value is not None:
+                mask[(slice(None),) * axis + (slice(0, start),)] = False
+            max_value = chunk_max
+            nr_voxels = 0
+        np.equal(image_chunk, max_value, out=mask[chunk])
+        nr_voxels += int(np.count_nonzero(mask[chunk]))
+
+    if min_value == max_value and max_value == 0:
+        mask[...] = False
+        nr_voxels = 0
+    return mask, {"empty": nr_voxels == 0, "nr_voxels": nr_voxels, "min": min_value.item(), "max": max_value.item()}
 
 
 def image_to_np(image):
     image_np = np.asanyarray(image.dataobj)
-    if np.min(image_np) != np.max(image_np):
-        image_np = image_np == np.max(image_np)
+    mask, stats = extract_mask(image_np)
+    if stats["min"] != stats["max"]:
+        image_np = mask
     return image_np
 
 
@@ -23,3 +97,264 @@ def load_image(file):
     image_np = image_to_np(image)
 
     return image, image_np
+
+
+def _cache_key(file, canonical=True):
+    file_stat = os.stat(file)
+    key = '{0}|{1}|{2}'.format(os.path.abspath(file), file_stat.st_size, file_stat.st_mtime_ns)
+    if not canonical:
+        key += '|native'
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _load_cached_mask(cache_file):
+    image = nib.load(cache_file + '.nii', mmap='r')
+    with open(cache_file + '.json') as f:
+        stats = json.load(f)
+    # the uint8 data is memory-mapped, viewed as bool without a copy
+    mask = np.asanyarray(image.dataobj).view(bool)
+    return image, mask, stats
+
+
+def _save_cached_mask(cache_file, image, mask, stats):
+    header = image.header.copy()
+    header.set_data_dtype(np.uint8)
+    header.set_slope_inter(1, 0)
+    # write to temporary files first, so that concurrent workers never read a partial cache entry
+    tmp_suffix = '.{0}.tmp'.format(os.getpid())
+    nib.save(nib.Nifti1Image(mask.view(np.uint8), image.affine, header), cache_file + tmp_suffix + '.nii')
+    os.replace(cache_file + tmp_suffix + '.nii', cache_file + '.nii')
+    with open(cache_file + tmp_suffix + '.json', 'w') as f:
+        json.dump(stats, f)
+    os.replace(cache_file + tmp_suffix + '.json', cache_file + '.json')
+
+
+def load_mask(file, cache_dir=None, canonical=True):
+    """
+    Loads a binary mask (voxels equal to the maximum label) and its statistics, see extract_mask.
+    :param file: path to the Nifti file
+    :param cache_dir: None (default) or a folder caching the decoded masks. The canonical mask is stored there as an
+    uncompressed uint8 Nifti file (with the affine and header of the source) and its statistics as JSON, keyed by the
+    path, size and modification time of the source file. Later loads memory-map the cached mask instead of
+    decompressing the source again. The cached mask is read-only.
+    :param canonical: True (default) reorients the mask to the canonical (RAS) orientation. False keeps the voxel order
+    of the file, which avoids decoding the whole volume at once for files that are not canonical (see load_masks).
+    :return: the Nifti image (canonical or as stored), the binary mask and the statistics of the segmentation
+    """
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, _cache_key(file, canonical))
+        if os.path.exists(cache_file + '.json'):
+            return _load_cached_mask(cache_file)
+
+    image = _load_nifti(file)
+    if canonical:
+        image = nib.as_closest_canonical(image)
+    mask, stats = extract_mask(image.dataobj)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_cached_mask(cache_file, image, mask, stats)
+    return image, mask, stats
+
+
+def load_masks(files, cache_dir=None, max_workers=None):
+    """
+    Loads the binary masks of several files of the same patient, e.g. tumor, ablation and liver.
+    The files are loaded concurrently in a thread pool, the gzip decompression and numpy release the GIL.
+    If all files have the same shape and affine (read from the headers), the masks are kept in the voxel order of the
+    files: reorienting them all to the canonical orientation would not change their alignment, only cost a copy of
+    every volume. The spacing is then given by the zooms of the images in the same order. Use canonical_order to sort
+    results (e.g. the surface distances) like the canonical computation. Otherwise all masks are reoriented.
+    :param files: list of paths to Nifti files, None entries are skipped
+    :param cache_dir: None (default) or a folder caching the decoded masks (see load_mask)
+    :param max_workers: number of threads. None (default) loads all files at once.
+    :return: list with (Nifti image, binary mask, statistics) per file, None for the skipped files. The statistics
+    include the time spent loading the file in seconds ("load_time").
+    """
+    headers = [nib.load(file) if file is not None else None for file in files]
+    images = [image for image in headers if image is not None]
+    native = all(image.shape == images[0].shape and np.allclose(image.affine, images[0].affine) for image in images)
+
+    def load(file):
+        if file is None:
+            return None
+        start = time.perf_counter()
+        image, mask, stats = load_mask(file, cache_dir=cache_dir, canonical=not native)
+        return image, mask, dict(stats, load_time=time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(images), 1)) as executor:
+        return list(executor.map(load, files))
+
+
+def _canonical_grid(image):
+    """
+    Shape, affine and spacing (pixdim) of an image in the canonical (RAS) orientation, from its header only.
+    """
+    ornt = io_orientation(image.affine)
+    axes = ornt[:, 0].astype(np.int64)
+    shape = np.zeros(3, np.int64)
+    shape[axes] = image.shape[:3]
+    zooms = np.zeros(3)
+    zooms[axes] = image.header.get_zooms()[:3]
+    return tuple(shape), image.affine.dot(inv_ornt_aff(ornt, image.shape[:3])), zooms
+
+
+def validate_headers(files, atol=1e-4):
+    """
+    Checks that Nifti files (e.g. tumor, ablation and liver) are on the same voxel grid, reading only their headers.
+    The files are compared in the canonical orientation in which they are loaded, so the same grid stored in
+    different orientations is accepted.
+    :param files: list of paths to Nifti files, None entries are skipped
+    :param atol: absolute tolerance (mm) for the affines and the spacings
+    :raise ValueError: if the shapes, affines or spacings (pixdim) of the files differ
+    """
+    files = [file for file in files if file is not None]
+    errors = []
+    reference = None
+    for file in files:
+        grid = _canonical_grid(nib.load(file))
+        if reference is None:
+            reference = grid
+            continue
+        for name, value, reference_value in zip(['shape', 'affine', 'spacing'], grid, reference):
+            if np.shape(value) != np.shape(reference_value) or not np.allclose(value, reference_value, rtol=0,
+                                                                                 atol=atol):
+                errors.append('The {0} of {1} differs from {2}:\n{3}\n{4}'.format(
+                    name, file, files[0], np.asarray(value), np.asarray(reference_value)))
+    if len(errors) > 0:
+        raise ValueError('\n'.join(errors))
+
+
+def _canonical_indices(indices, affine, shape):
+    """
+    Maps voxel indices (N, 3) of a volume to the voxel indices of its canonical (RAS) orientation.
+    """
+    indices = np.asarray(indices)
+    canonical = np.empty_like(indices)
+    for axis, (canonical_axis, flip) in enumerate(io_orientation(affine).astype(np.int64)):
+        canonical[..., canonical_axis] = shape[axis] - 1 - indices[..., axis] if flip == -1 else indices[..., axis]
+    return canonical
+
+
+def canonical_order(indices, affine, shape):
+    """
+    Order of voxels in the canonical (RAS) orientation, e.g. to sort the surface distances computed on masks in the
+    voxel order of the files (see load_masks) like the surface distances computed on canonical masks.
+    :param indices: (N, 3) voxel indices, e.g. "border_indices_gt" of compute_distances
+    :param affine: affine of the images
+    :param shape: shape of the images
+    :return: index array sorting the voxels in C order of the canonical volume
+    """
+    canonical = _canonical_indices(indices, affine, shape)
+    return np.lexsort(canonical.T[::-1])
+
+
+def load_label_map(file):
+    """
+    Loads a label map (e.g. tumor k and ablation 100+k of every lesion) without binarizing it.
+    :param file: path to the Nifti file
+    :return: the canonical Nifti image and the integer label array
+    """
+    image = nib.load(file)
+    image = nib.as_closest_canonical(image)
+    label_map = np.asanyarray(image.dataobj)
+    if not np.issubdtype(label_map.dtype, np.integer):
+        label_map = np.rint(label_map).astype(np.int32)
+
+    return image, label_map
+
+
+def _nonzero_bounds(mask):
+    """
+    Lower and upper (inclusive) index of the non-zero voxels along every axis, None if the mask is empty.
+    """
+    bounds = []
+    for axis in range(mask.ndim):
+        idx = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(idx) == 0:
+            return None
+        bounds.append((idx[0], idx[-1]))
+    return np.array(bounds, dtype=np.int64).T
+
+
+def load_mask_cropped(file, slab_size=16):
+    """
+    Loads a binary mask cropped to its bounding box, in canonical (RAS) orientation like load_image.
+    The volume is read once, in slabs of slab_size slices along the last (slowest on disk) axis. Only the voxels equal
+    to the running maximum are kept, cropped to their bounding box in every slab, so the full volume is never
+    decompressed into memory at once. The mask is the same as load_image(file)[1] within the bounding box.
+    :param file: path to the Nifti file
+    :param slab_size: number of slices read at once
+    :return: the Nifti image of the crop (canonical, its affine maps the crop), the cropped binary mask and the
+    offset of the crop in the canonical volume. The mask has shape (0, 0, 0) if the volume is empty.
+    """
+    image = nib.load(file, keep_file_open=True)
+    shape = image.shape
+    max_value = None
+    min_value = None
+    slabs = []
+    for z0 in range(0, shape[-1], slab_size):
+        data = np.asanyarray(image.dataobj[..., z0:z0 + slab_size])
+        slab_min, slab_max = data.min(), data.max()
+        min_value = slab_min if min_value is None else min(min_value, slab_min)
+        if max_value is None or slab_max > max_value:
+            # a new maximum label, the voxels kept so far are background
+            max_value = slab_max
+            slabs = []
+        if slab_max == max_value:
+            slab_mask = data == max_value
+            bounds = _nonzero_bounds(slab_mask)
+            if bounds is not None:
+                slab_mask = slab_mask[tuple(slice(lo, hi + 1) for lo, hi in zip(*bounds))]
+                bounds[:, -1] += z0
+                slabs.append((bounds, slab_mask))
+
+    if len(slabs) == 0 or min_value == max_value == 0:
+        # empty volume (a constant non-zero volume is a full mask, like in image_to_np)
+        slabs = []
+        bbox_min = np.zeros(len(shape), np.int64)
+        bbox_max = bbox_min - 1
+    else:
+        bbox_min = np.min([bounds[0] for bounds, _ in slabs], axis=0)
+        bbox_max = np.max([bounds[1] for bounds, _ in slabs], axis=0)
+    mask = np.zeros(bbox_max - bbox_min + 1, dtype=bool)
+    for bounds, slab_mask in slabs:
+        lo = bounds[0] - bbox_min
+        mask[tuple(slice(l, l + n) for l, n in zip(lo, slab_mask.shape))] = slab_mask
+
+    # reorient the crop like nib.as_closest_canonical
+    ornt = io_orientation(image.affine)
+    canonical_affine = image.affine.dot(inv_ornt_aff(ornt, shape))
+    mask = apply_orientation(mask, ornt)
+    offset = np.minimum(_canonical_indices(bbox_min, image.affine, shape),
+                        _canonical_indices(bbox_max, image.affine, shape))
+    if len(slabs) == 0:
+        offset[:] = 0
+
+    affine = canonical_affine.dot(nib.affines.from_matvec(np.eye(3), offset))
+    image_crop = nib.Nifti1Image(mask.astype(np.uint8), affine, image.header)
+    return image_crop, mask, offset
+
+
+def align_crops(masks, offsets):
+    """
+    Embeds cropped masks (e.g. from load_mask_cropped) into their common bounding box, so they can be passed
+    to compute_distances together.
+    :param masks: list of cropped masks
+    :param offsets: offsets of the crops in the full volume
+    :return: list of masks with the same shape and the offset of the common bounding box in the full volume
+    """
+    non_empty = [(mask, np.asarray(offset)) for mask, offset in zip(masks, offsets) if mask.size > 0]
+    if len(non_empty) == 0:
+        raise ValueError("Cannot align empty masks")
+    bbox_min = np.min([offset for _, offset in non_empty], axis=0)
+    bbox_max = np.max([offset + mask.shape for mask, offset in non_empty], axis=0)
+    aligned = []
+    for mask, offset in zip(masks, offsets):
+        aligned_mask = np.zeros(bbox_max - bbox_min, dtype=bool)
+        if mask.size > 0:
+            lo = np.asarray(offset) - bbox_min
+            aligned_mask[tuple(slice(l, l + n) for l, n in zip(lo, mask.shape))] = mask
+        aligned.append(aligned_mask)
+    return aligned, bbox_min
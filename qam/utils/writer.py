@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Writers (and readers) of the surface distances and the coverage data in several file formats.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    # optional, needed for Parquet and Feather (pip install pyarrow)
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+OUTPUT_FORMATS = ['xlsx', 'parquet', 'feather', 'npz', 'csv']
+
+
+def output_format_from_file(output_file):
+    """
+    Output format given by the extension of a file, e.g. Margin.parquet -> parquet
+    """
+    output_format = os.path.splitext(output_file)[1].lstrip('.').lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format '{0}' of {1}. Available formats: {2}".format(
+            output_format, output_file, OUTPUT_FORMATS))
+    return output_format
+
+
+def _write_xlsx(output_file, patient_id, distances, coverage_data):
+    df = pd.concat([pd.DataFrame(data={'Patient': [patient_id] * len(lesion_distances),
+                                       'Lesion': [lesion_id] * len(lesion_distances),
+                                       'Distances': lesion_distances})
+                    for lesion_id, lesion_distances in distances.items()])
+    writer = pd.ExcelWriter(output_file)
+    df.to_excel(writer, sheet_name='surface_distances', index=False, float_format='%.4f')
+    df_percentages_coverage = pd.DataFrame(coverage_data)
+    df_percentages_coverage.to_excel(writer, sheet_name='percentages_coverage', index=False, float_format='%.4f')
+    writer.save()
+
+
+def _metadata(patient_id, distances, coverage_data):
+    return {'Patient': str(patient_id), 'Lesions': [str(lesion_id) for lesion_id in distances],
+            'coverage': coverage_data}
+
+
+def _write_arrow(output_file, output_format, patient_id, distances, coverage_data):
+    if pa is None:
+        raise ImportError("Writing {0} files requires pyarrow (pip install pyarrow)".format(output_format))
+    lesion_ids = np.repeat(np.arange(len(distances), dtype=np.int32),
+                           [len(lesion_distances) for lesion_distances in distances.values()])
+    table = pa.table({
+        'Lesion': pa.DictionaryArray.from_arrays(lesion_ids, [str(lesion_id) for lesion_id in distances]),
+        'Distances': np.concatenate([np.asarray(d, dtype=np.float32) for d in distances.values()])})
+    metadata = json.dumps(_metadata(patient_id, distances, coverage_data), default=float)
+    table = table.replace_schema_metadata({'qam': metadata})
+    if output_format == 'parquet':
+        pq.write_table(table, output_file)
+    else:
+        feather.write_feather(table, output_file)
+
+
+def _write_npz(output_file, patient_id, distances, coverage_data):
+    arrays = {'distances_L{0}'.format(lesion_id): np.asarray(lesion_distances, dtype=np.float32)
+              for lesion_id, lesion_distances in distances.items()}
+    metadata = json.dumps(_metadata(patient_id, distances, coverage_data), default=float)
+    np.savez_compressed(output_file, metadata=np.array(metadata), **arrays)
+
+
+def _write_csv(output_file, patient_id, distances, coverage_data):
+    df = pd.DataFrame({'Lesion': np.repeat([str(lesion_id) for lesion_id in distances],
+                                           [len(lesion_distances) for lesion_distances in distances.values()]),
+                       'Distances': np.concatenate([np.asarray(d, dtype=np.float32) for d in distances.values()])})
+    with open(output_file, 'w', newline='') as f:
+        f.write('# Patient: {0}\n'.format(patient_id))
+        df.to_csv(f, index=False, float_format='%.4f')
+    root, ext = os.path.splitext(output_file)
+    pd.DataFrame(coverage_data).to_csv(root + '_coverage' + ext, index=False, float_format='%.4f')
+
+
+def write_distances(output_file, patient_id, distances, coverage_data, output_format=None):
+    """
+    Saves the surface distances and the coverage data of one or more lesions of a patient.
+    xlsx: one row per surface distance with the patient and lesion (sheet surface_distances) and the coverage data
+    (sheet percentages_coverage), as written by previous versions.
+    parquet, feather: float32 column Distances and dictionary encoded column Lesion. The patient, the lesions and the
+    coverage data are stored as JSON in the schema metadata (key "qam"). Requires pyarrow.
+    npz: compressed float32 array distances_L[LesionId] per lesion and the metadata as JSON (key "metadata").
+    csv: columns Lesion and Distances after a comment line with the patient (read with pandas.read_csv(...,
+    comment='#')). The coverage data are saved to [name]_coverage.csv.
+    :param output_file: output file
+    :param patient_id: patient id
+    :param distances: dictionary with the surface distances of every lesion id
+    :param coverage_data: list with the coverage data of every lesion (see qam.cohort.margin_data)
+    :param output_format: None (default) for the format given by the extension of output_file, or one of
+    OUTPUT_FORMATS
+    """
+    if output_format is None:
+        output_format = output_format_from_file(output_file)
+    if output_format == 'xlsx':
+        _write_xlsx(output_file, patient_id, distances, coverage_data)
+    elif output_format in ['parquet', 'feather']:
+        _write_arrow(output_file, output_format, patient_id, distances, coverage_data)
+    elif output_format == 'npz':
+        _write_npz(output_file, patient_id, distances, coverage_data)
+    elif output_format == 'csv':
+        _write_csv(output_file, patient_id, distances, coverage_data)
+    else:
+        raise ValueError("Unknown output format '{0}'. Available formats: {1}".format(output_format,
+                                                                                      OUTPUT_FORMATS))
+
+
+def _split_lesions(lesion_ids, lesion_column, distances):
+    return {lesion_id: distances[lesion_column == lesion_id] for lesion_id in lesion_ids}
+
+
+def read_distances(input_file, output_format=None):
+    """
+    Reads the surface distances saved by write_distances.
+    :param input_file: file written by write_distances
+    :param output_format: None (default) for the format given by the extension of input_file, or one of OUTPUT_FORMATS
+    :return: patient id and dictionary with the surface distances of every lesion id. The lesion ids are strings,
+    except for xlsx files where they are read as saved by Excel.
+    """
+    if output_format is None:
+        output_format = output_format_from_file(input_file)
+    if output_format == 'xlsx':
+        df = pd.read_excel(input_file, sheet_name='surface_distances')
+        distances = _split_lesions(pd.unique(df['Lesion']), df['Lesion'].values, df['Distances'].values)
+        return df['Patient'].iloc[0], distances
+    elif output_format in ['parquet', 'feather']:
+        if pa is None:
+            raise ImportError("Reading {0} files requires pyarrow (pip install pyarrow)".format(output_format))
+        table = pq.read_table(input_file) if output_format == 'parquet' else feather.read_table(input_file)
+        metadata = json.loads(table.schema.metadata[b'qam'])
+        lesion_column = np.asarray(table.column('Lesion').to_pandas(), dtype=object)
+        distances = table.column('Distances').to_numpy()
+        return metadata['Patient'], _split_lesions(metadata['Lesions'], lesion_column, distances)
+    elif output_format == 'npz':
+        with np.load(input_file) as arrays:
+            metadata = json.loads(str(arrays['metadata']))
+            distances = {lesion_id: arrays['distances_L{0}'.format(lesion_id)] for lesion_id in metadata['Lesions']}
+        return metadata['Patient'], distances
+    elif output_format == 'csv':
+        with open(input_file, newline='') as f:
+            patient_id = f.readline()[len('# Patient: '):].rstrip('\r\n')
+            df = pd.read_csv(f, dtype={'Lesion': str})
+        distances = _split_lesions(pd.unique(df['Lesion']), df['Lesion'].values,
+                                   df['Distances'].values.astype(np.float32))
+        return patient_id, distances
+    else:
+        raise ValueError("Unknown output format '{0}'. Available formats: {1}".format(output_format,
+                                                                                      OUTPUT_FORMATS))
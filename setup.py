@@ -33,7 +33,9 @@ setuptools.setup(
         "xlrd>=1.2.0"
     ],
     extras_require = {
-        '3d':  ["vtk>=9.0.1"]
+        '3d':  ["vtk>=9.0.1"],
+        'fast-gzip': ["isal>=1.0"],
+        'parquet': ["pyarrow>=5.0"]
     },
     classifiers=[
         "Programming Language :: Python :: 3",
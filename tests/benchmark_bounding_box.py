@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the bounding box computation on 512^3 masks (tumor, ablation and liver).
+
+    python benchmark_bounding_box.py
+"""
+import sys
+
+sys.path.insert(0, "..")
+import timeit
+
+import numpy as np
+
+from qam.margin import compute_bounding_box
+
+
+def compute_bounding_box_combined(mask_gt, mask_pred, exclusion_zone):
+    """
+    Previous implementation: combines the masks and projects the combined mask onto every axis.
+    """
+    mask_all = mask_gt | mask_pred
+    mask_all = mask_all | exclusion_zone
+    bbox_min = np.zeros(3, np.int64)
+    bbox_max = np.zeros(3, np.int64)
+    for axis, other_axes in enumerate([(2, 1), (2, 0), (1, 0)]):
+        proj = np.max(np.max(mask_all, axis=other_axes[0]), axis=other_axes[1])
+        idx_nonzero = np.nonzero(proj)[0]
+        bbox_min[axis] = np.min(idx_nonzero)
+        bbox_max[axis] = np.max(idx_nonzero)
+    return bbox_min, bbox_max
+
+
+if __name__ == '__main__':
+    shape = (512, 512, 512)
+    for order in ['C', 'F']:
+        tumor = np.zeros(shape, dtype=bool, order=order)
+        ablation = np.zeros(shape, dtype=bool, order=order)
+        liver = np.zeros(shape, dtype=bool, order=order)
+        tumor[200:240, 210:260, 300:330] = True
+        ablation[190:250, 200:270, 290:340] = True
+        liver[100:400, 120:420, 80:380] = True
+
+        bbox_combined = compute_bounding_box_combined(tumor, ablation, liver)
+        bbox = compute_bounding_box(tumor, ablation, liver)
+        assert np.array_equal(bbox_combined[0], bbox[0]) and np.array_equal(bbox_combined[1], bbox[1])
+
+        number = 5
+        time_combined = timeit.timeit(lambda: compute_bounding_box_combined(tumor, ablation, liver), number=number)
+        time_bbox = timeit.timeit(lambda: compute_bounding_box(tumor, ablation, liver), number=number)
+        print('{0}-order 512^3: combined mask {1:.1f} ms, per mask projections {2:.1f} ms'.format(
+            order, time_combined / number * 1000, time_bbox / number * 1000))
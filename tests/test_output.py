@@ -1,10 +1,24 @@
 import sys
 
 sys.path.insert(0, "..")
+import contextlib
+import gzip
+import io
+import json
 import os
+import re
+import shutil
+import tempfile
 import unittest
-from qam import margin
-from utils import niftireader
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from qam import cohort, margin, plotting, report
+from utils import niftireader, writer
 
 OUTPUT_FILE = 'data/_output/Grouped.csv'
 
@@ -269,5 +283,920 @@ class TestSubcapsularLesions(unittest.TestCase):
         self.assertAlmostEqual(record["max_distance"], 5.74, delta=0.01)
 
 
+class TestBoundingBox(unittest.TestCase):
+    def test_01_union_of_masks(self):
+        masks = [np.zeros((20, 30, 40), dtype=bool) for _ in range(4)]
+        masks[0][5:8, 10:12, 20:30] = True
+        masks[1][6:10, 3:5, 22:25] = True
+        masks[2][2, 20, 39] = True
+
+        bbox_min, bbox_max = margin.compute_bounding_box(*masks)
+        np.testing.assert_array_equal(bbox_min, [2, 3, 20])
+        np.testing.assert_array_equal(bbox_max, [9, 20, 39])
+
+        bbox_min, bbox_max = margin.compute_bounding_box(*[np.asfortranarray(mask) for mask in masks], padding=3)
+        np.testing.assert_array_equal(bbox_min, [0, 0, 17])
+        np.testing.assert_array_equal(bbox_max, [12, 23, 39])
+
+    def test_02_padding_mm(self):
+        mask = np.zeros((20, 30, 40), dtype=bool)
+        mask[10, 15, 20] = True
+
+        bbox_min, bbox_max = margin.compute_bounding_box(mask, padding=5, spacing_mm=(0.7, 0.7, 5))
+        np.testing.assert_array_equal(bbox_min, [2, 7, 19])
+        np.testing.assert_array_equal(bbox_max, [18, 23, 21])
+
+
+class TestNarrowBand(unittest.TestCase):
+    def test_01_same_as_full_distance_maps(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Ablation'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, None, 1)
+        distances_band = margin.compute_distances(tumor_np, ablation_np, None, 1, narrow_band_mm=30)
+
+        np.testing.assert_allclose(distances_band['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+        np.testing.assert_allclose(distances_band['distances_pred_to_gt'], distances['distances_pred_to_gt'])
+
+    def test_02_same_as_full_distance_maps_subcapsular(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Ablation'))
+        _, liver_np = niftireader.load_image(_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Liver'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1)
+        distances_band = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, narrow_band_mm=30)
+
+        np.testing.assert_allclose(distances_band['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+        np.testing.assert_allclose(distances_band['distances_pred_to_gt'], distances['distances_pred_to_gt'])
+
+    def test_03_distances_outside_band(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T01', '01_no_overlap_10mm_margin', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T01', '01_no_overlap_10mm_margin', 'Ablation'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, None, 1)['distances_gt_to_pred']
+        distances_band = margin.compute_distances(tumor_np, ablation_np, None, 1,
+                                                  narrow_band_mm=15)['distances_gt_to_pred']
+
+        within_band = np.abs(distances) <= 15
+        np.testing.assert_allclose(distances_band[within_band], distances[within_band])
+        self.assertTrue(np.all(distances_band[~within_band] == -np.Inf))
+
+
+class TestCropping(unittest.TestCase):
+    def test_01_same_as_uncropped(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T02', '06_shifted_ablation_5mm_xy_margin_subcapsular', 'Tumor'))
+        _, ablation_np = niftireader.load_image(
+            _get_file_name('T02', '06_shifted_ablation_5mm_xy_margin_subcapsular', 'Ablation'))
+        _, liver_np = niftireader.load_image(_get_file_name('T02', '06_shifted_ablation_5mm_xy_margin_subcapsular', 'Liver'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, crop=False)
+        for crop_padding_mm in [0, 3, 15]:
+            distances_cropped = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, crop=True,
+                                                         crop_padding_mm=crop_padding_mm)
+            np.testing.assert_array_equal(distances_cropped['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+            np.testing.assert_array_equal(distances_cropped['distances_pred_to_gt'], distances['distances_pred_to_gt'])
+
+    def test_02_crop_offset(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Ablation'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, None, 1, crop=False)
+        distances_cropped = margin.compute_distances(tumor_np, ablation_np, None, 1, crop=True)
+
+        # the cropped borders are views of the original volume at the crop offset
+        borders_gt = np.zeros(tumor_np.shape, dtype=bool)
+        offset = distances_cropped['crop_offset']
+        borders_gt[tuple(slice(o, o + n) for o, n in zip(offset, distances_cropped['borders_gt'].shape))] = \
+            distances_cropped['borders_gt']
+        np.testing.assert_array_equal(borders_gt, distances['borders_gt'])
+        self.assertEqual(distances_cropped['crop_shape'], distances_cropped['borders_gt'].shape)
+
+    def test_03_border_coordinates(self):
+        image, tumor_np = niftireader.load_image(_get_file_name('T02', '02_5mm_margin_subcapsular', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T02', '02_5mm_margin_subcapsular', 'Ablation'))
+        _, liver_np = niftireader.load_image(_get_file_name('T02', '02_5mm_margin_subcapsular', 'Liver'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, crop=False, affine=image.affine)
+        distances_cropped = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, crop=True,
+                                                     affine=image.affine)
+        distances_kdtree = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, engine='kdtree',
+                                                    affine=image.affine)
+        for result in [distances_cropped, distances_kdtree]:
+            for key in ['border_indices_gt', 'border_indices_pred', 'border_coordinates_gt',
+                        'border_coordinates_pred']:
+                np.testing.assert_array_equal(result[key], distances[key])
+
+        # one index per surface distance, pointing at the border voxels in the original volume
+        indices = distances_cropped['border_indices_gt']
+        self.assertEqual(len(indices), len(distances_cropped['distances_gt_to_pred']))
+        self.assertTrue(distances['borders_gt'][tuple(indices.T)].all())
+        np.testing.assert_allclose(distances_cropped['border_coordinates_gt'],
+                                   margin.voxel_to_world(indices, image.affine))
+
+    def test_04_same_as_uncropped_anisotropic(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T02', '09_shifted_ablation_5mm_z_margin_subcapsular', 'Tumor'))
+        _, ablation_np = niftireader.load_image(
+            _get_file_name('T02', '09_shifted_ablation_5mm_z_margin_subcapsular', 'Ablation'))
+        _, liver_np = niftireader.load_image(_get_file_name('T02', '09_shifted_ablation_5mm_z_margin_subcapsular', 'Liver'))
+        spacing = (0.7, 0.7, 5)
+
+        distances = margin.compute_distances(tumor_np, ablation_np, liver_np, spacing, crop=False)
+        for crop_padding_mm in [0, 3, 15, (1, 1, 10)]:
+            for local_exclusion in [False, True]:
+                distances_cropped = margin.compute_distances(tumor_np, ablation_np, liver_np, spacing, crop=True,
+                                                             crop_padding_mm=crop_padding_mm,
+                                                             local_exclusion=local_exclusion)
+                np.testing.assert_array_equal(distances_cropped['distances_gt_to_pred'],
+                                              distances['distances_gt_to_pred'])
+                np.testing.assert_array_equal(distances_cropped['distances_pred_to_gt'],
+                                              distances['distances_pred_to_gt'])
+                crop = tuple(slice(o, o + n) for o, n in zip(distances_cropped['crop_offset'],
+                                                             distances_cropped['crop_shape']))
+                for key in ['borders_gt', 'borders_pred', 'distmap_gt', 'distmap_pred']:
+                    np.testing.assert_array_equal(distances_cropped[key], distances[key][crop])
+
+    def test_05_negative_padding(self):
+        mask = np.zeros((10, 10, 10), dtype=bool)
+        mask[4:6, 4:6, 4:6] = True
+        self.assertRaises(ValueError, margin.compute_distances, mask, mask, None, 1, crop_padding_mm=-1)
+
+
+class TestLocalExclusion(unittest.TestCase):
+    def test_01_same_as_whole_exclusion_zone(self):
+        for lesion_id in ['01_0mm_margin_subcapsular', '04_2mm_shifted_tumor_subcapsular',
+                          '06_shifted_ablation_5mm_xy_margin_subcapsular']:
+            _, tumor_np = niftireader.load_image(_get_file_name('T02', lesion_id, 'Tumor'))
+            _, ablation_np = niftireader.load_image(_get_file_name('T02', lesion_id, 'Ablation'))
+            _, liver_np = niftireader.load_image(_get_file_name('T02', lesion_id, 'Liver'))
+
+            distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1)
+            distances_local = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, local_exclusion=True)
+            np.testing.assert_array_equal(distances_local['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+            np.testing.assert_array_equal(distances_local['distances_pred_to_gt'], distances['distances_pred_to_gt'])
+            # the crop does not include the whole exclusion zone
+            self.assertLessEqual(np.prod(distances_local['crop_shape']), np.prod(distances['crop_shape']))
+            self.assertEqual(distances_local['distmap_exclusion'].shape, distances_local['crop_shape'])
+
+    def test_02_lesion_outside_exclusion_zone(self):
+        # the liver border is further than the exclusion distance from the lesion
+        liver = np.zeros((80, 40, 40), dtype=bool)
+        liver[:20] = True
+        tumor = np.zeros_like(liver)
+        tumor[55:60, 15:20, 15:20] = True
+        ablation = np.zeros_like(liver)
+        ablation[52:63, 12:23, 12:23] = True
+
+        distances = margin.compute_distances(tumor, ablation, liver, 1)
+        distances_local = margin.compute_distances(tumor, ablation, liver, 1, local_exclusion=True)
+        self.assertEqual(len(distances['distances_gt_to_pred']), 0)
+        np.testing.assert_array_equal(distances_local['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+        np.testing.assert_array_equal(distances_local['distances_pred_to_gt'], distances['distances_pred_to_gt'])
+        self.assertTrue(np.all(distances_local['distmap_exclusion'] == -np.Inf))
+        distances_batch, = margin.compute_distances_batch([(tumor, ablation)], liver, 1)
+        np.testing.assert_array_equal(distances_batch['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+
+        # far inside the liver nothing is excluded
+        distances_inside = margin.compute_distances(tumor, ablation, ~liver, 1, local_exclusion=True)
+        np.testing.assert_array_equal(distances_inside['distances_gt_to_pred'],
+                                      margin.compute_distances(tumor, ablation, None, 1)['distances_gt_to_pred'])
+
+
+class TestMemoryLean(unittest.TestCase):
+    def test_01_same_as_float64(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T02', '06_shifted_ablation_5mm_xy_margin_subcapsular', 'Tumor'))
+        _, ablation_np = niftireader.load_image(
+            _get_file_name('T02', '06_shifted_ablation_5mm_xy_margin_subcapsular', 'Ablation'))
+        _, liver_np = niftireader.load_image(_get_file_name('T02', '06_shifted_ablation_5mm_xy_margin_subcapsular', 'Liver'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1)
+        distances_lean = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, memory_lean=True)
+
+        self.assertEqual(distances_lean['distmap_pred'].dtype, np.float32)
+        self.assertIsNone(distances_lean['distmask_pred'])
+        np.testing.assert_allclose(distances_lean['distances_gt_to_pred'], distances['distances_gt_to_pred'], rtol=1e-6)
+        np.testing.assert_allclose(distances_lean['distances_pred_to_gt'], distances['distances_pred_to_gt'], rtol=1e-6)
+
+
+class TestOutputs(unittest.TestCase):
+    def test_01_only_requested_outputs(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T02', '02_5mm_margin_subcapsular', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T02', '02_5mm_margin_subcapsular', 'Ablation'))
+        _, liver_np = niftireader.load_image(_get_file_name('T02', '02_5mm_margin_subcapsular', 'Liver'))
+
+        distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1)
+        for engine in ['edt', 'kdtree']:
+            distances_gt_to_pred = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, engine=engine,
+                                                            outputs={'distances_gt_to_pred'})
+            self.assertEqual(list(distances_gt_to_pred.keys()), ['distances_gt_to_pred'])
+            np.testing.assert_allclose(distances_gt_to_pred['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+
+    def test_02_unknown_output(self):
+        mask = np.zeros((5, 5, 5), dtype=bool)
+        with self.assertRaises(ValueError):
+            margin.compute_distances(mask, mask, None, 1, outputs={'distances'})
+
+
+class TestKDTreeEngine(unittest.TestCase):
+    def _assert_same_as_edt(self, case_id, lesion_id, with_liver):
+        _, tumor_np = niftireader.load_image(_get_file_name(case_id, lesion_id, 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name(case_id, lesion_id, 'Ablation'))
+        liver_np = niftireader.load_image(_get_file_name(case_id, lesion_id, 'Liver'))[1] if with_liver else None
+
+        distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1)
+        distances_kdtree = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, engine='kdtree')
+
+        np.testing.assert_allclose(distances_kdtree['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+        np.testing.assert_allclose(distances_kdtree['distances_pred_to_gt'], distances['distances_pred_to_gt'])
+
+    def test_01_same_as_edt(self):
+        for lesion_id in ['01_no_overlap_10mm_margin', '02_perfect_overlap_0mm_margin', '03_perfect_overlap_10mm_margin',
+                          '05_perfect_overlap_-5mm_margin', '06_perfect_shifted_5mm_xy_margin']:
+            self._assert_same_as_edt('T01', lesion_id, with_liver=False)
+
+    def test_02_same_as_edt_subcapsular(self):
+        for lesion_id in ['01_0mm_margin_subcapsular', '03_-5mm_margin_subcapsular', '04_2mm_shifted_tumor_subcapsular',
+                          '06_shifted_ablation_5mm_xy_margin_subcapsular']:
+            self._assert_same_as_edt('T02', lesion_id, with_liver=True)
+
+    def test_03_unknown_engine(self):
+        mask = np.zeros((5, 5, 5), dtype=bool)
+        with self.assertRaises(ValueError):
+            margin.compute_distances(mask, mask, None, 1, engine='unknown')
+
+
+class TestBatch(unittest.TestCase):
+    def test_01_same_as_single_lesions(self):
+        lesion_ids = ['02_5mm_margin_subcapsular', '03_-5mm_margin_subcapsular', '04_2mm_shifted_tumor_subcapsular',
+                      '07_shifted_5mm_x_margin_subcapsular']
+        _, liver_np = niftireader.load_image(_get_file_name('T02', lesion_ids[0], 'Liver'))
+        lesions = [(niftireader.load_image(_get_file_name('T02', lesion_id, 'Tumor'))[1],
+                    niftireader.load_image(_get_file_name('T02', lesion_id, 'Ablation'))[1])
+                   for lesion_id in lesion_ids]
+
+        results = margin.compute_distances_batch(lesions, liver_np, 1)
+
+        self.assertEqual(len(results), len(lesions))
+        for (tumor_np, ablation_np), result in zip(lesions, results):
+            distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1)
+            np.testing.assert_array_equal(result['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+            np.testing.assert_array_equal(result['distances_pred_to_gt'], distances['distances_pred_to_gt'])
+
+
+class TestLabelMap(unittest.TestCase):
+    def test_01_same_as_single_lesions(self):
+        lesion_ids = ['02_5mm_margin_subcapsular', '03_-5mm_margin_subcapsular', '07_shifted_5mm_x_margin_subcapsular']
+        _, liver_np = niftireader.load_image(_get_file_name('T02', lesion_ids[0], 'Liver'))
+        tumor_labels = np.zeros(liver_np.shape, dtype=np.uint8)
+        ablation_labels = np.zeros(liver_np.shape, dtype=np.uint8)
+        lesions = {}
+        for label, lesion_id in enumerate(lesion_ids, start=1):
+            _, tumor_np = niftireader.load_image(_get_file_name('T02', lesion_id, 'Tumor'))
+            _, ablation_np = niftireader.load_image(_get_file_name('T02', lesion_id, 'Ablation'))
+            # move the lesions apart so that they do not overlap
+            shift = (label - 2) * 30
+            tumor_np = np.roll(tumor_np, shift, axis=1)
+            ablation_np = np.roll(ablation_np, shift, axis=1)
+            tumor_labels[tumor_np] = label
+            ablation_labels[ablation_np] = 100 + label
+            lesions[label] = (tumor_np, ablation_np)
+
+        results = margin.compute_distances_label_map(tumor_labels, liver_np, 1, ablation_label_map=ablation_labels)
+
+        self.assertEqual(sorted(results.keys()), [1, 2, 3])
+        for label, (tumor_np, ablation_np) in lesions.items():
+            distances = margin.compute_distances(tumor_np, ablation_np, liver_np, 1)
+            np.testing.assert_array_equal(results[label]['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+
+    def test_02_single_label_map(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T01', '01_no_overlap_10mm_margin', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T01', '01_no_overlap_10mm_margin', 'Ablation'))
+        label_map = np.zeros(tumor_np.shape, dtype=np.uint8)
+        label_map[tumor_np] = 1
+        label_map[ablation_np] = 101
+
+        # a tumor outside its ablation is not ablated
+        with self.assertWarns(UserWarning):
+            results = margin.compute_distances_label_map(label_map, None, 1)
+        distances = margin.compute_distances(tumor_np, ablation_np, None, 1)
+        self.assertEqual(list(results.keys()), [1])
+        np.testing.assert_array_equal(results[1]['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+        self.assertLess(np.max(results[1]['distances_gt_to_pred']), 0)
+
+        ablation_label_map = label_map * (label_map > 100)
+        results = margin.compute_distances_label_map(label_map, None, 1, ablation_label_map=ablation_label_map)
+        np.testing.assert_array_equal(results[1]['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+
+    def test_03_protruding_tumor(self):
+        # the tumor extends outside its ablation, the tumor voxels written over the ablation are not ablated
+        _, tumor_np = niftireader.load_image(_get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Ablation'))
+        label_map = np.zeros(tumor_np.shape, dtype=np.uint8)
+        label_map[ablation_np] = 101
+        label_map[tumor_np] = 1
+
+        with self.assertWarns(UserWarning):
+            results = margin.compute_distances_label_map(label_map, None, 1)
+        distances = margin.compute_distances(tumor_np, ablation_np & ~tumor_np, None, 1)
+        np.testing.assert_array_equal(results[1]['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+        self.assertLess(np.min(results[1]['distances_gt_to_pred']), 0)
+
+    def test_04_tumor_inside_ablation(self):
+        # a voxel holds only one label, the tumor (label 1) covers the inside of the ablation (label 101)
+        _, tumor_np = niftireader.load_image(_get_file_name('T01', '03_perfect_overlap_10mm_margin', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T01', '03_perfect_overlap_10mm_margin', 'Ablation'))
+        label_map = np.zeros(tumor_np.shape, dtype=np.uint8)
+        label_map[ablation_np] = 101
+        label_map[tumor_np] = 1
+
+        distances = margin.compute_distances(tumor_np, ablation_np, None, 1)
+        for crop in [True, False]:
+            results = margin.compute_distances_label_map(label_map, None, 1, crop_padding_mm=15, crop=crop)
+            np.testing.assert_array_equal(results[1]['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+            self.assertAlmostEqual(np.min(results[1]['distances_gt_to_pred']), 9.05, delta=0.01)
+
+    def test_05_ablation_covered_by_tumor(self):
+        # the ablations of the 0 mm and -5 mm margins are completely covered by their tumors
+        lesion_ids = ['03_perfect_overlap_10mm_margin', '05_perfect_overlap_-5mm_margin',
+                      '02_perfect_overlap_0mm_margin']
+        label_map = np.zeros((100, 100, 100), dtype=np.uint8)
+        for label, lesion_id in enumerate(lesion_ids, start=1):
+            _, tumor_np = niftireader.load_image(_get_file_name('T01', lesion_id, 'Tumor'))
+            _, ablation_np = niftireader.load_image(_get_file_name('T01', lesion_id, 'Ablation'))
+            # move the lesions apart so that they do not overlap
+            shift = (label - 2) * 30
+            label_map[np.roll(ablation_np, shift, axis=1)] = 100 + label
+            label_map[np.roll(tumor_np, shift, axis=1)] = label
+
+        results = margin.compute_distances_label_map(label_map, None, 1)
+        self.assertEqual(sorted(results.keys()), [1, 2, 3])
+        self.assertAlmostEqual(np.min(results[1]['distances_gt_to_pred']), 9.05, delta=0.01)
+        self.assertIsNone(results[2])
+        self.assertIsNone(results[3])
+
+
+class TestCroppedLoading(unittest.TestCase):
+    def test_01_same_as_load_image(self):
+        for segmentation in ['Tumor', 'Ablation', 'Liver']:
+            file = _get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', segmentation)
+            _, mask_np = niftireader.load_image(file)
+            image_crop, mask_crop, offset = niftireader.load_mask_cropped(file, slab_size=7)
+            crop = tuple(slice(o, o + n) for o, n in zip(offset, mask_crop.shape))
+            np.testing.assert_array_equal(mask_crop, mask_np[crop])
+            self.assertEqual(mask_crop.sum(), mask_np.sum())
+            self.assertEqual(image_crop.shape, mask_crop.shape)
+
+    def test_02_reoriented_image(self):
+        data = np.zeros((40, 30, 50), dtype=np.int16)
+        data[5:20, 3:9, 10:33] = 2
+        data[30, 25, 45] = 1
+        affine = np.array([[0, 0, -5, 10], [0, -0.7, 0, 3], [0.8, 0, 0, -7], [0, 0, 0, 1]])
+        with tempfile.TemporaryDirectory() as folder:
+            file = os.path.join(folder, 'mask.nii.gz')
+            nib.save(nib.Nifti1Image(data, affine), file)
+            image, mask_np = niftireader.load_image(file)
+            image_crop, mask_crop, offset = niftireader.load_mask_cropped(file, slab_size=7)
+
+        crop = tuple(slice(o, o + n) for o, n in zip(offset, mask_crop.shape))
+        np.testing.assert_array_equal(mask_crop, mask_np[crop])
+        self.assertEqual(mask_crop.sum(), mask_np.sum())
+        np.testing.assert_allclose(image_crop.affine, image.affine.dot(nib.affines.from_matvec(np.eye(3), offset)))
+        self.assertEqual(image_crop.header.get_zooms(), image.header.get_zooms())
+
+    def test_03_align_crops(self):
+        tumor_file = _get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Tumor')
+        ablation_file = _get_file_name('T01', '06_perfect_shifted_5mm_xy_margin', 'Ablation')
+        _, tumor_np = niftireader.load_image(tumor_file)
+        _, ablation_np = niftireader.load_image(ablation_file)
+        _, tumor_crop, tumor_offset = niftireader.load_mask_cropped(tumor_file)
+        _, ablation_crop, ablation_offset = niftireader.load_mask_cropped(ablation_file)
+
+        (tumor_crop, ablation_crop), offset = niftireader.align_crops([tumor_crop, ablation_crop],
+                                                                      [tumor_offset, ablation_offset])
+        distances = margin.compute_distances(tumor_np, ablation_np, None, 1)
+        distances_crop = margin.compute_distances(tumor_crop, ablation_crop, None, 1)
+        np.testing.assert_array_equal(distances_crop['distances_gt_to_pred'], distances['distances_gt_to_pred'])
+        np.testing.assert_array_equal(distances_crop['crop_offset'] + offset, distances['crop_offset'])
+
+
+class TestExtractMask(unittest.TestCase):
+    def test_01_same_as_image_to_np(self):
+        rng = np.random.default_rng(0)
+        for order in ['C', 'F']:
+            for nr_labels in [1, 2, 4]:
+                image_np = np.asarray(rng.integers(0, nr_labels, size=(7, 9, 11)), order=order).astype(np.int16)
+                mask, stats = niftireader.extract_mask(image_np, chunk_voxels=50)
+                expected = image_np == image_np.max() if nr_labels > 1 else image_np.astype(bool)
+                np.testing.assert_array_equal(mask, expected)
+                self.assertEqual(stats['nr_voxels'], expected.sum())
+                self.assertEqual(stats['empty'], not expected.any())
+                self.assertEqual(stats['min'], image_np.min())
+                self.assertEqual(stats['max'], image_np.max())
+
+    def test_02_load_mask(self):
+        for segmentation in ['Tumor', 'Ablation', 'Liver']:
+            file = _get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', segmentation)
+            _, mask_np = niftireader.load_image(file)
+            _, mask, stats = niftireader.load_mask(file)
+            np.testing.assert_array_equal(mask, mask_np)
+            self.assertEqual(stats['nr_voxels'], mask_np.sum())
+
+    def test_03_cache(self):
+        file = _get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Liver')
+        image, mask, stats = niftireader.load_mask(file)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            niftireader.load_mask(file, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            image_cached, mask_cached, stats_cached = niftireader.load_mask(file, cache_dir=cache_dir)
+            self.assertIsInstance(mask_cached, np.memmap)
+            np.testing.assert_array_equal(mask_cached, mask)
+            np.testing.assert_array_equal(image_cached.affine, image.affine)
+            np.testing.assert_array_equal(image_cached.header['pixdim'], image.header['pixdim'])
+            self.assertEqual(stats_cached, stats)
+            del image_cached, mask_cached
+
+    def test_04_load_masks(self):
+        files = [_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', segmentation)
+                 for segmentation in ['Tumor', 'Ablation', 'Liver']]
+        masks = niftireader.load_masks(files + [None], max_workers=2)
+        self.assertIsNone(masks[-1])
+        for file, (_, mask, stats) in zip(files, masks):
+            _, mask_np = niftireader.load_image(file)
+            np.testing.assert_array_equal(mask, mask_np)
+            self.assertGreaterEqual(stats['load_time'], 0)
+
+    def test_05_fast_gzip_backend(self):
+        file = _get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Tumor')
+        image, mask, stats = niftireader.load_mask(file)
+        # the same in-memory decompression as with ISA-L, using the gzip module of the standard library
+        with mock.patch.object(niftireader, 'igzip', gzip):
+            image_fast, mask_fast, stats_fast = niftireader.load_mask(file)
+        np.testing.assert_array_equal(mask_fast, mask)
+        np.testing.assert_array_equal(image_fast.affine, image.affine)
+        self.assertEqual(stats_fast, stats)
+
+    def test_06_validate_headers(self):
+        files = [_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', segmentation)
+                 for segmentation in ['Tumor', 'Ablation', 'Liver']]
+        niftireader.validate_headers(files + [None])
+        with tempfile.TemporaryDirectory() as folder:
+            image = nib.load(files[1])
+            data = np.asanyarray(image.dataobj)
+            # same grid stored in another orientation
+            reoriented_file = os.path.join(folder, 'reoriented.nii.gz')
+            nib.save(image.as_reoriented(nib.orientations.axcodes2ornt(('P', 'S', 'L'))), reoriented_file)
+            niftireader.validate_headers([files[0], reoriented_file])
+            for affine in [np.diag([1, 1, 2, 1]), nib.affines.from_matvec(np.eye(3), [0, 0, 1])]:
+                misaligned_file = os.path.join(folder, 'misaligned.nii.gz')
+                nib.save(nib.Nifti1Image(data, affine), misaligned_file)
+                self.assertRaises(ValueError, niftireader.validate_headers, [files[0], misaligned_file])
+            nib.save(nib.Nifti1Image(data[:-1], image.affine), misaligned_file)
+            self.assertRaises(ValueError, niftireader.validate_headers, [files[0], misaligned_file])
+
+    def test_07_many_slices(self):
+        data = np.zeros((64, 64, 200), dtype=np.uint8)
+        data[10:50, 20:40, 30:170] = 1
+        opener_init = nib.openers.Opener.__init__
+        opened = []
+
+        def counting_init(self, *args, **kwargs):
+            opened.append(args)
+            opener_init(self, *args, **kwargs)
+
+        extract_mask = niftireader.extract_mask
+        with tempfile.TemporaryDirectory() as folder:
+            file = os.path.join(folder, 'many_slices.nii.gz')
+            nib.save(nib.Nifti1Image(data, np.eye(4)), file)
+            # 50 chunks of 4 slices, the file is decompressed once and not once per chunk
+            with mock.patch.object(nib.openers.Opener, '__init__', counting_init), \
+                    mock.patch.object(niftireader, 'extract_mask',
+                                      lambda image_np: extract_mask(image_np, chunk_voxels=64 * 64 * 4)):
+                image, mask, stats = niftireader.load_mask(file, canonical=False)
+            np.testing.assert_array_equal(mask, data.astype(bool))
+            self.assertLess(len(opened), 10)
+            del image
+
+
+class TestNativeOrientation(unittest.TestCase):
+    def test_01_same_as_canonical(self):
+        lesion_id = '06_shifted_ablation_5mm_xy_margin_subcapsular'
+        with tempfile.TemporaryDirectory() as folder:
+            # the test cases stored in a non-canonical orientation with an anisotropic spacing
+            files = []
+            for segmentation in ['Tumor', 'Ablation', 'Liver']:
+                image = nib.load(_get_file_name('T02', lesion_id, segmentation))
+                image = nib.Nifti1Image(np.asanyarray(image.dataobj), np.diag([0.7, 0.8, 2, 1]))
+                ornt = nib.orientations.axcodes2ornt(('P', 'S', 'L'))
+                files.append(os.path.join(folder, segmentation + '.nii.gz'))
+                nib.save(image.as_reoriented(ornt), files[-1])
+
+            canonical = [niftireader.load_mask(file) for file in files]
+            native = niftireader.load_masks(files)
+            self.assertNotEqual(nib.aff2axcodes(native[0][0].affine), ('R', 'A', 'S'))
+
+            spacing = canonical[1][0].header.get_zooms()
+            distances = margin.compute_distances(canonical[0][1], canonical[1][1], canonical[2][1], spacing)
+            image = native[1][0]
+            distances_native = margin.compute_distances(native[0][1], native[1][1], native[2][1],
+                                                        image.header.get_zooms(),
+                                                        outputs={'distances_gt_to_pred', 'border_indices_gt'})
+            order = niftireader.canonical_order(distances_native['border_indices_gt'], image.affine, image.shape)
+            np.testing.assert_array_equal(distances_native['distances_gt_to_pred'][order],
+                                          distances['distances_gt_to_pred'])
+
+
+class TestWriter(unittest.TestCase):
+    distances = {1: np.array([-1.5, 0, 2.25, 7]), 2: np.array([3.5, 4])}
+    coverage_data = [{'Patient': 'T01', 'Lesion': 1, 'x_less_than_0mm': 25.0},
+                     {'Patient': 'T01', 'Lesion': 2, 'x_less_than_0mm': 0.0}]
+
+    def test_01_npz(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output_file = os.path.join(folder, 'Margin.npz')
+            writer.write_distances(output_file, 'T01', self.distances, self.coverage_data)
+            with np.load(output_file) as data:
+                for lesion_id, distances in self.distances.items():
+                    self.assertEqual(data['distances_L{0}'.format(lesion_id)].dtype, np.float32)
+                    np.testing.assert_array_equal(data['distances_L{0}'.format(lesion_id)], distances)
+                metadata = json.loads(str(data['metadata']))
+        self.assertEqual(metadata['Patient'], 'T01')
+        self.assertEqual(metadata['Lesions'], ['1', '2'])
+        self.assertEqual(metadata['coverage'], self.coverage_data)
+
+    def test_02_csv(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output_file = os.path.join(folder, 'Margin.csv')
+            writer.write_distances(output_file, 'T01', self.distances, self.coverage_data)
+            df = pd.read_csv(output_file, comment='#')
+            df_coverage = pd.read_csv(os.path.join(folder, 'Margin_coverage.csv'))
+        np.testing.assert_array_equal(df['Distances'], np.concatenate(list(self.distances.values())))
+        np.testing.assert_array_equal(df['Lesion'], [1, 1, 1, 1, 2, 2])
+        self.assertEqual(len(df_coverage), 2)
+
+    def test_03_xlsx(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output_file = os.path.join(folder, 'Margin.xlsx')
+            writer.write_distances(output_file, 'T01', self.distances, self.coverage_data)
+            df = pd.read_excel(output_file, sheet_name='surface_distances')
+        self.assertEqual(list(df.columns), ['Patient', 'Lesion', 'Distances'])
+        np.testing.assert_array_equal(df['Distances'], np.concatenate(list(self.distances.values())))
+
+    @unittest.skipIf(writer.pa is None, "pyarrow is not installed")
+    def test_04_parquet_feather(self):
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+        with tempfile.TemporaryDirectory() as folder:
+            for output_format, read_table in [('parquet', pq.read_table), ('feather', feather.read_table)]:
+                output_file = os.path.join(folder, 'Margin.' + output_format)
+                writer.write_distances(output_file, 'T01', self.distances, self.coverage_data)
+                table = read_table(output_file)
+                self.assertEqual(table.schema.field('Distances').type, 'float')
+                np.testing.assert_array_equal(table.column('Distances').to_numpy(),
+                                              np.concatenate(list(self.distances.values())))
+                self.assertEqual(json.loads(table.schema.metadata[b'qam'])['Patient'], 'T01')
+
+    def test_05_unknown_format(self):
+        self.assertRaises(ValueError, writer.output_format_from_file, 'Margin.txt')
+
+    def test_06_read_distances(self):
+        output_formats = ['npz', 'csv', 'xlsx'] + (['parquet', 'feather'] if writer.pa is not None else [])
+        with tempfile.TemporaryDirectory() as folder:
+            for output_format in output_formats:
+                output_file = os.path.join(folder, 'Margin.' + output_format)
+                writer.write_distances(output_file, 'T01', self.distances, self.coverage_data)
+                patient_id, distances = writer.read_distances(output_file)
+                self.assertEqual(patient_id, 'T01')
+                self.assertEqual([str(lesion_id) for lesion_id in distances], ['1', '2'])
+                for expected, lesion_distances in zip(self.distances.values(), distances.values()):
+                    np.testing.assert_allclose(lesion_distances, expected, atol=1e-4)
+
+
+def _spheres(spacing, radii, centers, size=70):
+    # spheres on a grid of the given spacing, not centered on a voxel
+    grid = np.meshgrid(*[(np.arange(int(round(size / s))) - size / 2 / s + 0.3) * s for s in spacing], indexing='ij')
+    return [sum((x - c) ** 2 for x, c in zip(grid, center)) <= radius ** 2 for radius, center in zip(radii, centers)]
+
+
+class TestSurfaceArea(unittest.TestCase):
+    def test_01_sphere(self):
+        # the staircase surface overestimates the area, more with thicker slices (see surface_area_weights)
+        for spacing, ratio in [((1, 1, 1), 1.07), ((0.5, 0.5, 1), 1.10), ((0.7, 0.7, 2.5), 1.17),
+                               ((0.7, 0.7, 5), 1.25)]:
+            sphere, = _spheres(spacing, [20], [(0, 0, 0)])
+            borders = margin.extract_borders(sphere)
+            areas = margin.surface_area_weights(sphere, borders, spacing)
+            self.assertEqual(len(areas), borders.sum())
+            self.assertTrue(np.all(areas > 0))
+            self.assertAlmostEqual(areas.sum() / (4 * np.pi * 20 ** 2), ratio, delta=0.01)
+
+    def test_02_box(self):
+        # flat faces of a box are counted once, only the edges and corners are bevelled
+        box = np.zeros((12, 12, 6), dtype=bool)
+        box[1:11, 1:11, 1:5] = True
+        spacing = (0.7, 0.7, 5)
+        areas = margin.surface_area_weights(box, margin.extract_borders(box), spacing)
+        outer = 2 * (10 * 0.7 * 10 * 0.7 + 10 * 0.7 * 4 * 5 * 2)
+        inner = 2 * (9 * 0.7 * 9 * 0.7 + 9 * 0.7 * 3 * 5 * 2)
+        self.assertGreater(areas.sum(), inner)
+        self.assertLess(areas.sum(), outer)
+
+    def test_03_compute_distances(self):
+        _, tumor_np = niftireader.load_image(_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Tumor'))
+        _, ablation_np = niftireader.load_image(_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Ablation'))
+        _, liver_np = niftireader.load_image(_get_file_name('T02', '04_2mm_shifted_tumor_subcapsular', 'Liver'))
+        outputs = {'distances_gt_to_pred', 'border_indices_gt', 'surface_areas_gt'}
+        distances = margin.compute_distances(tumor_np, ablation_np, None, 1, outputs=outputs)
+        distances_subcapsular = margin.compute_distances(tumor_np, ablation_np, liver_np, 1, outputs=outputs)
+        self.assertEqual(len(distances['surface_areas_gt']), len(distances['distances_gt_to_pred']))
+        # the areas of the border voxels outside the exclusion zone are unchanged
+        kept = (distances['border_indices_gt'][:, None] ==
+                distances_subcapsular['border_indices_gt'][None]).all(axis=2).any(axis=1)
+        np.testing.assert_array_equal(distances['surface_areas_gt'][kept], distances_subcapsular['surface_areas_gt'])
+        self.assertNotIn('surface_areas_gt', margin.compute_distances(tumor_np, ablation_np, None, 1))
+
+    def test_04_weighted_summary(self):
+        distances = np.array([-2, -1, 0, 1, 5, 7], dtype=float)
+        np.testing.assert_allclose(margin.weighted_quantile(distances, np.ones(6), 0.5), np.median(distances))
+        self.assertEqual(margin.weighted_quantile(distances, [0, 0, 0, 1, 0, 0], 0.25), 1)
+        surface_distance = {'distances_gt_to_pred': distances, 'surface_areas_gt': np.array([1, 1, 1, 1, 2, 2.])}
+        df = margin.summarize_surface_dists('T01', 'L01', surface_distance, weighted=True)
+        record = df.iloc[0]
+        self.assertEqual(record['surface_area'], 8)
+        self.assertAlmostEqual(record['x_less_than_0mm'], 2 / 8)
+        self.assertAlmostEqual(record['x_equal_greater_than_5m'], 4 / 8)
+
+    def test_05_anisotropic_coverage(self):
+        # weighted coverage fractions at anisotropic spacings against a fine isotropic reference
+        thresholds = (0, 1, 2, 3, 5)
+
+        def fractions(spacing, weighted):
+            tumor, ablation = _spheres(spacing, [12, 17], [(0, 0, 0), (4, 2, 0)])
+            distances = margin.compute_distances(tumor, ablation, None, spacing,
+                                                 outputs={'distances_gt_to_pred', 'surface_areas_gt'})
+            summary = margin.summarize_distances(distances['distances_gt_to_pred'], thresholds=thresholds,
+                                                 weights=distances['surface_areas_gt'] if weighted else None)
+            return np.array([summary['below_{0:g}mm'.format(t)] for t in thresholds])
+
+        reference = fractions((0.25, 0.25, 0.25), False)
+        np.testing.assert_allclose(fractions((0.25, 0.25, 0.25), True), reference, atol=0.01)
+        for spacing, error in [((0.5, 0.5, 1), 0.03), ((0.7, 0.7, 2.5), 0.1), ((0.7, 0.7, 5), 0.23)]:
+            self.assertLess(np.max(np.abs(fractions(spacing, True) - reference)), error)
+        # at 0.5x0.5x1 mm the weights halve the error of the voxel counts, the distances of 5 mm slices are too coarse
+        self.assertLess(np.max(np.abs(fractions((0.5, 0.5, 1), True) - reference)),
+                        np.max(np.abs(fractions((0.5, 0.5, 1), False) - reference)) * 0.7)
+        self.assertGreater(np.max(np.abs(fractions((0.7, 0.7, 5), True) - reference)), 0.15)
+
+
+class TestSummary(unittest.TestCase):
+    def test_01_same_as_numpy(self):
+        rng = np.random.default_rng(0)
+        for n in [1, 2, 7, 1000]:
+            distances = rng.normal(2, 4, n)
+            distances[::5] = np.round(distances[::5])
+            summary = margin.summarize_distances(distances, percentiles=(0, 2.5, 25, 50, 75, 100),
+                                                 thresholds=(-1, 0, 2, 5))
+            self.assertEqual(summary['nr_values'], n)
+            self.assertEqual(summary['min'], np.min(distances))
+            self.assertEqual(summary['max'], np.max(distances))
+            for p in [0, 2.5, 25, 50, 75, 100]:
+                self.assertAlmostEqual(summary['p{0:g}'.format(p)], np.percentile(distances, p))
+            for t in [-1, 0, 2, 5]:
+                self.assertAlmostEqual(summary['below_{0:g}mm'.format(t)], np.mean(distances < t))
+
+    def test_02_nan_and_empty(self):
+        summary = margin.summarize_distances([np.nan, 1, 3, np.nan], thresholds=(2,))
+        self.assertEqual(summary['nr_values'], 2)
+        self.assertEqual(summary['p50'], 2)
+        self.assertEqual(summary['below_2mm'], 0.5)
+        summary = margin.summarize_distances([], thresholds=(0,))
+        self.assertEqual(summary['nr_values'], 0)
+        self.assertTrue(np.isnan(summary['p25']))
+        self.assertTrue(np.isnan(summary['below_0mm']))
+
+    def test_03_weighted(self):
+        distances = np.array([3, -2, 7, 0, 1, 5], dtype=float)
+        weights = np.array([1, 1, 2, 1, 1, 2], dtype=float)
+        summary = margin.summarize_distances(distances, percentiles=(25, 50), thresholds=(0, 5), weights=weights)
+        np.testing.assert_allclose([summary['p25'], summary['p50']],
+                                   margin.weighted_quantile(distances, weights, [0.25, 0.5]))
+        self.assertAlmostEqual(summary['below_0mm'], 1 / 8)
+        self.assertAlmostEqual(summary['below_5mm'], 4 / 8)
+
+    def test_04_legacy_columns(self):
+        distances = np.random.default_rng(1).normal(2, 4, 500)
+        record = margin.summarize_surface_dists('T01', 'L01', {'distances_gt_to_pred': distances}).iloc[0]
+        self.assertAlmostEqual(record['q25_distance'], np.quantile(distances, 0.25))
+        self.assertAlmostEqual(record['median_distance'], np.median(distances))
+        self.assertAlmostEqual(record['x_less_than_0mm'], np.sum(distances < 0) / len(distances))
+        self.assertAlmostEqual(record['x_equal_greater_than_0m'], np.sum(distances < 5) / len(distances))
+        self.assertAlmostEqual(record['x_equal_greater_than_5m'], np.sum(distances >= 5) / len(distances))
+
+
+class TestCoveragePercentages(unittest.TestCase):
+    def test_01_same_as_histogram(self):
+        rng = np.random.default_rng(2)
+        for distances in [rng.normal(2, 4, 1000), np.round(rng.normal(2, 4, 200)), np.array([-0.5, 4.99, 5.0]),
+                          rng.normal(8, 1, 50).astype(np.float32)]:
+            percentages = margin.coverage_percentages(distances)
+            np.testing.assert_allclose(percentages, plotting.plot_histogram_surface_distances(
+                'T01', 1, None, distances, 'Quantitative Ablation Margin'), atol=1e-10)
+            self.assertAlmostEqual(percentages.sum(), 100)
+
+    def test_02_thresholds(self):
+        np.testing.assert_allclose(margin.coverage_percentages([-1, 1, 2, 3, np.nan], thresholds=(2,)), [50, 50])
+        self.assertTrue(np.isnan(margin.coverage_percentages([])).all())
+
+    def test_03_no_plot(self):
+        distances = np.random.default_rng(3).normal(2, 4, 100)
+        with tempfile.TemporaryDirectory() as folder:
+            output_file = os.path.join(folder, 'Histogram.png')
+            patient_data = cohort.margin_data('T01', 1, distances, output_file)
+            self.assertTrue(os.path.exists(output_file))
+            with mock.patch.object(plotting, 'render_histogram_surface_distances') as plot:
+                self.assertEqual(cohort.margin_data('T01', 1, distances), patient_data)
+                plot.assert_not_called()
+
+
+class TestRendering(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.distances = [rng.normal(2, 4, 500), rng.normal(-3, 2, 300), rng.normal(8, 3, 100), np.array([])]
+
+    def _render(self, folder, name, distances):
+        output_file = os.path.join(folder, name + '.png')
+        percentages = plotting.render_histogram_surface_distances('T01', name, output_file, distances,
+                                                                  'Quantitative Ablation Margin', dpi=50,
+                                                                  figsize=(6, 5))
+        with open(output_file, 'rb') as f:
+            return percentages, f.read()
+
+    def test_01_percentages(self):
+        for distances in self.distances[:3]:
+            np.testing.assert_allclose(plotting.render_histogram_surface_distances(
+                'T01', 1, None, distances, 'Quantitative Ablation Margin'), plotting.plot_histogram_surface_distances(
+                'T01', 1, None, distances, 'Quantitative Ablation Margin'), atol=1e-10)
+
+    def test_02_template_reused(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # the previous lesion does not change the figure of the next one
+            _, first = self._render(folder, 'a', self.distances[1])
+            self._render(folder, 'b', self.distances[0])
+            _, again = self._render(folder, 'a', self.distances[1])
+            self.assertEqual(first, again)
+
+    def test_03_threads(self):
+        with tempfile.TemporaryDirectory() as folder:
+            expected = [self._render(folder, str(i), d) for i, d in enumerate(self.distances)]
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda i: self._render(folder, str(i % 4), self.distances[i % 4]),
+                                            range(16)))
+            for i, (percentages, image) in enumerate(results):
+                np.testing.assert_array_equal(percentages, expected[i % 4][0])
+                self.assertEqual(image, expected[i % 4][1])
+
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.lesions = [('T01', lesion_id, rng.normal(2, 4, 100)) for lesion_id in range(5)]
+
+    def test_01_panel_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            panel_files, nr_rendered = report.render_panels(self.lesions, folder, jobs=2, dpi=20)
+            self.assertEqual(nr_rendered, 5)
+            self.assertTrue(all(os.path.exists(panel_file) for panel_file in panel_files))
+            # only the new and the changed lesions are rendered again
+            lesions = self.lesions[:4] + [('T01', 4, self.lesions[4][2] + 1), ('T02', 1, self.lesions[0][2])]
+            panel_files_new, nr_rendered = report.render_panels(lesions, folder, jobs=1, dpi=20)
+            self.assertEqual(nr_rendered, 2)
+            self.assertEqual(panel_files_new[:4], panel_files[:4])
+            self.assertEqual(len(os.listdir(folder)), 7)
+
+    def test_02_pdf(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output_files, nr_rendered = report.cohort_report(self.lesions, os.path.join(folder, 'Report.pdf'),
+                                                             jobs=1, columns=2, rows=1, dpi=20)
+            self.assertEqual(output_files, [os.path.join(folder, 'Report.pdf')])
+            self.assertEqual(len(os.listdir(os.path.join(folder, 'Report_panels'))), 5)
+            with open(output_files[0], 'rb') as f:
+                self.assertEqual(len(re.findall(rb'/Type /Page\b', f.read())), 3)
+
+    def test_03_image_grid(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output_files, _ = report.cohort_report(self.lesions, os.path.join(folder, 'Report.png'), jobs=1,
+                                                   columns=3, rows=1, dpi=20)
+            self.assertEqual([os.path.basename(x) for x in output_files], ['Report_p1.png', 'Report_p2.png'])
+            output_files, nr_rendered = report.cohort_report(self.lesions[:3], os.path.join(folder, 'Report.png'),
+                                                             jobs=1, columns=3, rows=1, dpi=20)
+            self.assertEqual(nr_rendered, 0)
+            self.assertEqual(output_files, [os.path.join(folder, 'Report.png')])
+            self.assertRaises(ValueError, report.cohort_report, self.lesions, os.path.join(folder, 'Report.svg'))
+
+
+_process_lesion = cohort.process_lesion
+
+
+def _process_lesion_killing_worker(lesion, **kwargs):
+    # simulates a worker process killed while computing lesion 02, e.g. when out of memory
+    if lesion['lesion_id'] == '02_perfect_overlap_0mm_margin':
+        os._exit(1)
+    return _process_lesion(lesion, **kwargs)
+
+
+class TestCohort(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.folder.name, 'cohort')
+        shutil.copytree(os.path.join('test_data', 'T01'), os.path.join(self.root, 'T01'))
+        os.remove(os.path.join(self.root, 'T01', '09_perfect_shifted_5mm_z_margin',
+                               'T01_L09_perfect_shifted_5mm_z_margin_Liver.nii.gz'))
+        # a lesion whose tumor file is truncated: the header is valid, reading the data fails
+        lesion_folder = os.path.join(self.root, 'T03', '01')
+        os.makedirs(lesion_folder)
+        for segmentation in ['Tumor', 'Ablation']:
+            file = _get_file_name('T01', '01_no_overlap_10mm_margin', segmentation)
+            with open(file, 'rb') as f:
+                data = f.read()
+            with open(os.path.join(lesion_folder, 'T03_L01_{0}.nii.gz'.format(segmentation)), 'wb') as f:
+                f.write(data[:len(data) // 2] if segmentation == 'Tumor' else data)
+        self.output_dir = os.path.join(self.folder.name, 'output')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_01_discover_lesions(self):
+        lesions = cohort.discover_lesions(self.root)
+        self.assertEqual(len(lesions), 10)
+        self.assertEqual(lesions[-1]['patient_id'], 'T03')
+        self.assertIsNone(lesions[-1]['liver'])
+        self.assertIsNone(lesions[-2]['liver'])
+        self.assertTrue(os.path.exists(lesions[0]['liver']))
+
+    def test_02_run_cohort(self):
+        df_coverage, df_failures = cohort.run_cohort(self.root, self.output_dir, jobs=1, plot=False,
+                                                     output_format='npz')
+        self.assertEqual(len(df_coverage), 9)
+        self.assertEqual(list(df_failures['Patient']), ['T03'])
+        self.assertEqual(len(os.listdir(os.path.join(self.output_dir, 'distances'))), 9)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'histograms')))
+        df_aggregated = pd.read_excel(os.path.join(self.output_dir, 'Aggregated.xlsx'), sheet_name=None)
+        self.assertEqual(len(df_aggregated['percentages_coverage']), 9)
+        self.assertEqual(len(df_aggregated['failures']), 1)
+        # same margins as computed for single lesions
+        lesion_id = '03_perfect_overlap_10mm_margin'
+        record = df_coverage[df_coverage['Lesion'] == lesion_id].iloc[0]
+        _, distances = writer.read_distances(os.path.join(self.output_dir, 'distances',
+                                                          'T01_L{0}_Distances.npz'.format(lesion_id)))
+        self.assertAlmostEqual(record['min_distance'], np.min(distances[lesion_id]), places=4)
+        self.assertAlmostEqual(record['x_equal_greater_than_5m'], 100)
+
+    def test_03_worker_killed(self):
+        pools = []
+
+        class ProcessPoolExecutor(cohort.ProcessPoolExecutor):
+            def __init__(self, max_workers=None):
+                pools.append(max_workers)
+                super().__init__(max_workers)
+
+        with mock.patch.object(cohort, 'process_lesion', _process_lesion_killing_worker), \
+                mock.patch.object(cohort, 'ProcessPoolExecutor', ProcessPoolExecutor):
+            df_coverage, df_failures = cohort.run_cohort(self.root, self.output_dir, jobs=2, plot=False,
+                                                         output_format='npz')
+        # the lesions after the killed worker are computed in a new pool, only the lesions running when the pool
+        # broke are retried one at a time
+        self.assertEqual(pools[:2], [2, 2])
+        self.assertLessEqual(pools.count(1), 2)
+        self.assertIn(1, pools)
+        self.assertEqual(len(df_coverage), 8)
+        self.assertEqual(sorted(df_failures['Lesion']), ['01', '02_perfect_overlap_0mm_margin'])
+        self.assertIn('BrokenProcessPool', df_failures.set_index('Lesion').loc['02_perfect_overlap_0mm_margin',
+                                                                                 'Error'])
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'Aggregated.xlsx')))
+
+    def test_04_main(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            cohort.main([self.root, '-o', self.output_dir, '-j', '1', '--no-plot', '--output-format', 'csv'])
+        self.assertIn('9 lesions computed, 1 failed', output.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'distances',
+                                                    'T01_L01_no_overlap_10mm_margin_Distances.csv')))
+
+    def test_05_lesion_distances(self):
+        lesion = cohort.discover_lesions(self.root)[2]
+        distances, error = cohort.lesion_distances(lesion['tumor'], lesion['ablation'], lesion['liver'])
+        self.assertIsNone(error)
+        _, tumor_np = niftireader.load_image(lesion['tumor'])
+        _, ablation_np = niftireader.load_image(lesion['ablation'])
+        _, liver_np = niftireader.load_image(lesion['liver'])
+        np.testing.assert_array_equal(np.sort(distances), np.sort(
+            margin.compute_distances(tumor_np, ablation_np, liver_np, 1)['distances_gt_to_pred']))
+
+        empty_file = os.path.join(self.folder.name, 'Empty.nii.gz')
+        nib.save(nib.Nifti1Image(np.zeros(tumor_np.shape, dtype=np.uint8), nib.load(lesion['tumor']).affine),
+                 empty_file)
+        distances, error = cohort.lesion_distances(empty_file, lesion['ablation'])
+        self.assertIsNone(distances)
+        self.assertIn('No tumor segmentation', error)
+
+
 if __name__ == '__main__':
     unittest.main()